@@ -1,7 +1,8 @@
 from ming.odm import mapper
+from pymongo import ASCENDING
 from tgext.evolve import Evolution
 
-from ksweb.model import Workspace, DBSession
+from ksweb.model import Workspace, Questionary, DBSession, Output, Document, Precondition, Qa
 
 
 class WorkspaceEvolution(Evolution):
@@ -14,6 +15,75 @@ class WorkspaceEvolution(Evolution):
         DBSession.flush_all()
 
 
+class QuestionaryAnswersOrderEvolution(Evolution):
+    evolution_id = 'questionary_answers_order'
+
+    def evolve(self):
+        collection = mapper(Questionary).collection.m.collection
+        for questionary in collection.find({'answers_order': {'$exists': False}}, {'qa_values': 1}):
+            qa_values = questionary.get('qa_values', {})
+            answers_order = sorted(qa_values, key=lambda qa_id: qa_values[qa_id]['order_number'])
+            collection.update_one({'_id': questionary['_id']}, {'$set': {'answers_order': answers_order}})
+
+
+class EntityReferencesEvolution(Evolution):
+    evolution_id = 'entity_references'
+
+    def evolve(self):
+        for cls in (Output, Document, Precondition, Qa):
+            DBSession.ensure_indexes(mapper(cls).collection)
+            collection = mapper(cls).collection.m.collection
+            for entity in cls.query.find({'refs': {'$exists': False}}):
+                collection.update_one({'_id': entity._id},
+                                      {'$set': {'refs': sorted(set(entity.references()))}})
+        DBSession.clear()
+
+
+class StablePlaceholdersEvolution(Evolution):
+    evolution_id = 'stable_placeholders'
+
+    def evolve(self):
+        from ksweb.lib.utils import stable_placeholders
+        from ksweb.model.mapped_entity import calculate_hash
+        # all the placeholders are rewritten while hashes are still the ones they hold
+        for cls in (Output, Document):
+            collection = mapper(cls).collection.m.collection
+            for entity in collection.find({}, {'html': 1}):
+                html = stable_placeholders(entity.get('html'))
+                if html != entity.get('html'):
+                    collection.update_one({'_id': entity['_id']}, {'$set': {'html': html}})
+        for cls in (Output, Document):
+            collection = mapper(cls).collection.m.collection
+            for entity in cls.query.find():
+                collection.update_one({'_id': entity._id}, {'$set': {
+                    'hash': calculate_hash(entity),
+                    'refs': sorted(set(entity.references())),
+                }})
+        DBSession.clear()
+
+
+class TaggedHashesEvolution(Evolution):
+    evolution_id = 'tagged_hashes'
+    index_name = 'hash_unique'
+
+    def evolve(self):
+        from ksweb.model.mapped_entity import calculate_hash
+        for cls in (Output, Document, Precondition, Qa):
+            collection = mapper(cls).collection.m.collection
+            for entity in cls.query.find():
+                collection.update_one({'_id': entity._id}, {'$set': {'hash': calculate_hash(entity)}})
+            # legacy hashes could be duplicated, so the unique index is created only now
+            collection.create_index([('hash', ASCENDING)], unique=True, sparse=True, name=self.index_name)
+            for name, index in collection.index_information().items():
+                if name != self.index_name and [tuple(__) for __ in index['key']] == [('hash', 1)]:
+                    collection.drop_index(name)
+        DBSession.clear()
+
+
 evolutions = [
     WorkspaceEvolution,
+    QuestionaryAnswersOrderEvolution,
+    EntityReferencesEvolution,
+    StablePlaceholdersEvolution,
+    TaggedHashesEvolution,
 ]
@@ -5,6 +5,7 @@ import json
 import tg
 import yaml
 from bson import ObjectId
+from ksweb.lib.evaluator import bulk_evaluate
 from ksweb.lib.importers.yaml_importer import YamlImporter
 from tg.renderers import json as json_render
 from tgext.datahelpers.utils import slugify
@@ -185,6 +186,24 @@ class DocumentController(RestController):
         json_ = json.loads(encoded)
         return yaml.dump(json_, default_flow_style=False)
 
+    @expose("json")
+    @validate(
+        {"_id": DocumentExistValidator(required=True)},
+        error_handler=validation_errors_response,
+    )
+    @require(
+        CanManageEntityOwner(
+            msg=l_(u"You are not allowed to see the report of this document."),
+            field="_id",
+            entity_model=model.Document,
+        )
+    )
+    def outputs_report(self, _id, **kw):
+        """Outputs shown by each questionary of the document, see
+        :func:`ksweb.lib.evaluator.bulk_evaluate`"""
+        evaluation = bulk_evaluate(model.Document.by_id(_id))
+        return dict(evaluation, matrix=evaluation["matrix"].tolist())
+
     @expose()
     @validate(
         {"workspace": WorkspaceExistValidator(required=True)},
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 """Questionary controller module"""
-from tempfile import NamedTemporaryFile
+import json
+import os
 
-import pypandoc
 from bson import ObjectId
+from bson.errors import InvalidId
+from ksweb.lib import export
+from ksweb.lib.evaluator import decision_graph
+from ksweb.lib.graph import DocumentGraph
 from ksweb.lib.predicates import CanManageEntityOwner
+from ksweb.lib.render import cached_render, questionary_fragments, render_key
 from ksweb.lib.utils import (
     TemplateOutput,
     TemplateAnswer,
-    id_to_hash,
     find_entities_from_html,
 )
 from markupsafe import Markup
@@ -23,7 +27,7 @@ from tg import (
     request,
     tmpl_context,
 )
-from tg import redirect
+from tg import redirect, abort
 from tg.decorators import paginate, require
 from tg.i18n import lazy_ugettext as l_
 import tg
@@ -40,7 +44,6 @@ from ksweb.lib.validator import (
     QAExistValidator,
     WorkspaceExistValidator,
 )
-from ksweb.model import DBSession, Qa
 
 
 class FormController(BaseController):
@@ -163,11 +166,17 @@ class FormController(BaseController):
     )
     def compile(self, _id, **kwargs):
         questionary = model.Questionary.query.get(_id=ObjectId(_id))
+        graph = DocumentGraph(questionary.document)
+        quest_compiled = questionary.evaluate(graph, reset=True, persist=False)
+        outputs, answers = self._cached_fragments(questionary, graph)
         return dict(
             questionary=questionary,
-            quest_compiled=questionary.evaluate_questionary,
-            html=self.get_questionary_html(_id),
+            quest_compiled=quest_compiled,
+            html=self.questionary_html(questionary, graph),
             recap=questionary.answers,
+            document_html=questionary.document.html,
+            outputs=self._answered_outputs(outputs, answers),
+            answers=answers,
         )
 
     @expose(content_type="application/application/octet-stream")
@@ -182,59 +191,231 @@ class FormController(BaseController):
             entity_model=model.Questionary,
         )
     )
-    def download(self, _id, format):
+    def download(self, _id, format="docx", job=None):
         questionary = model.Questionary.query.get(_id=ObjectId(_id))
+        if job:
+            # jobs of other questionaries are not found through this one
+            if export.job_scope(job) != _id or export.status(job) != "done":
+                abort(404)
+            path = export.job_path(job)
+            format = job.rsplit(".", 1)[-1]
+        else:
+            if format not in export.FORMATS:
+                abort(400)
+            path = export.convert(self.get_questionary_markdown(_id), format, _id)
+
         filename = slugify(questionary, questionary.title)
-        response.headerlist.append(
-            ("Content-Disposition", f"attachment;filename={filename}.{format}")
+        return export.serve(path, f"{filename}.{format}")
+
+    @expose("json")
+    @validate(
+        {
+            "_id": QuestionaryExistValidator(required=True),
+            "format": StringLengthValidator(min=1, required=True),
+        },
+        error_handler=validation_errors_response,
+    )
+    @require(
+        CanManageEntityOwner(
+            msg=l_("You are not allowed to download this questionary."),
+            field="_id",
+            entity_model=model.Questionary,
         )
-        filled_md = self.get_questionary_html(_id)
-        unanswered, __ = find_entities_from_html(filled_md)
-        output = NamedTemporaryFile()
-        with NamedTemporaryFile() as input:
-            input.write(
-                TemplateOutput(filled_md)
-                .safe_substitute({k: "" for k in unanswered})
-                .encode()
-            )
-            input.seek(0)
-            pypandoc.convert_file(
-                input.name, format, format="md", outputfile=output.name
-            )
+    )
+    def prepare_download(self, _id, format, **kw):
+        if format not in export.FORMATS:
+            abort(400)
+        markdown = self.get_questionary_markdown(_id)
+        path = export.artifact_path(markdown, format, _id)
+        if not os.path.exists(path):
+            export.submit(markdown, format, _id)
+        return self._download_job(_id, export.job_id(path))
 
-        return output
+    @expose("json")
+    @validate(
+        {"_id": QuestionaryExistValidator(required=True)},
+        error_handler=validation_errors_response,
+    )
+    @require(
+        CanManageEntityOwner(
+            msg=l_("You are not allowed to download this questionary."),
+            field="_id",
+            entity_model=model.Questionary,
+        )
+    )
+    def download_status(self, _id, job=None, **kw):
+        return self._download_job(_id, job)
+
+    @staticmethod
+    def _download_job(_id, job):
+        status = export.status(job) if export.job_scope(job) == _id else "unknown"
+        return dict(
+            job=job,
+            status=status,
+            url=tg.url("/questionary/download", params=dict(_id=_id, job=job))
+            if status == "done"
+            else None,
+        )
+
+    @classmethod
+    def get_questionary_markdown(cls, quest_id):
+        filled_md = cls.get_questionary_html(quest_id)
+        unanswered, __ = find_entities_from_html(filled_md)
+        return TemplateOutput(filled_md).safe_substitute({k: "" for k in unanswered})
 
     @staticmethod
     def get_questionary_html(quest_id):
         questionary = model.Questionary.query.get(ObjectId(quest_id))
-        if not questionary.document.content:
+        return FormController.questionary_html(questionary)
+
+    @staticmethod
+    def questionary_html(questionary, graph=None):
+        graph = graph or DocumentGraph(questionary.document)
+        html = cached_render(
+            render_key(graph, questionary.qa_values),
+            lambda: FormController._render_questionary_html(questionary, graph),
+        )
+        return Markup(html) if html is not None else None
+
+    @staticmethod
+    def _render_questionary_html(questionary, graph):
+        if not [__ for __ in graph.outputs if __]:
             return
 
-        output_values, qa_values = dict(), dict()
-
-        for output_dict in questionary.document.content:
-            _id = output_dict["content"]
-            if (
-                output_dict["content"] in questionary.output_values
-                and questionary.output_values[output_dict["content"]][  # NOQA
-                    "evaluation"
-                ]
-            ):
-                output = model.Output.query.get(ObjectId(_id))
-                output_values[output.hash] = output.render(questionary.output_values)
-            else:
-                # this clear useless output placeholder
-                output_values[_id] = ""
-        safe_template = questionary.document.html
+        outputs, answers = FormController._cached_fragments(questionary, graph)
         questionary_with_expanded_output = TemplateOutput(
-            safe_template
-        ).safe_substitute(output_values)
-        questionary_compiled = TemplateAnswer(questionary_with_expanded_output)
+            questionary.document.html
+        ).safe_substitute(outputs)
+        return Markup(
+            TemplateAnswer(questionary_with_expanded_output).safe_substitute(answers)
+        )
+
+    @staticmethod
+    def _cached_fragments(questionary, graph):
+        """:meth:`_fragments` through the render cache, under the same key
+        of the html they compose"""
+        fragments = cached_render(
+            render_key(graph, questionary.qa_values) + ".fragments",
+            lambda: json.dumps(FormController._fragments(questionary, graph)),
+        )
+        outputs, answers = json.loads(fragments)
+        return outputs, answers
+
+    @staticmethod
+    def _fragments(questionary, graph):
+        # renders are cached by graph and answers, stored evaluations could be
+        # stale or partial so they are computed again, only in memory
+        questionary.evaluate(graph, persist=False)
+        return questionary_fragments(questionary, graph)
+
+    @staticmethod
+    def _delta_start(questionary, graph):
+        """State of the compiled questionary before changing the answers,
+        :meth:`_delta` returns what changed since then"""
+        questionary.evaluate(graph, persist=questionary.persist_evaluations())
+        return dict(
+            graph=graph,
+            shown=FormController._shown(questionary),
+            answers=FormController._responses(questionary),
+            answers_order=list(questionary.answers_order),
+        )
+
+    @staticmethod
+    def _delta(questionary, before):
+        """Only the outputs of the document containing an output shown or
+        hidden by the changes, or an answer that changed, are rendered again"""
+        graph = before["graph"]
+
+        def changed(previous, current):
+            return {
+                k
+                for k in set(previous) | set(current)
+                if previous.get(k) != current.get(k)
+            }
+
+        changed_outputs = before["shown"] ^ FormController._shown(questionary)
+        changed_answers = changed(
+            before["answers"], FormController._responses(questionary)
+        )
+        affected = {
+            str(__._id)
+            for __ in filter(None, graph.outputs)
+            if FormController._affected(__, graph, changed_outputs, changed_answers)
+        }
+        outputs, answers = questionary_fragments(questionary, graph, only=affected)
+        outputs = FormController._answered_outputs(outputs, answers)
+
+        kept = 0
+        answers_order = zip(before["answers_order"], questionary.answers_order)
+        for previous, current in answers_order:
+            if previous != current:
+                break
+            kept += 1
+        return dict(
+            quest_compiled=questionary.evaluation,
+            outputs={k: outputs.get(k) for k in affected},
+            answers={k: answers.get(k) for k in changed_answers},
+            recap=dict(kept=kept, answers=questionary.answers_from(kept)),
+        )
+
+    @staticmethod
+    def _shown(questionary):
+        return {k for k, v in questionary.output_values.items() if v.get("evaluation")}
+
+    @staticmethod
+    def _responses(questionary):
+        return {k: v["qa_response"] for k, v in questionary.qa_values.items()}
 
-        for qa_id, resp in questionary.qa_values.items():
-            qa_values[id_to_hash(qa_id, Qa)] = Markup.escape(resp["qa_response"])
+    @staticmethod
+    def _affected(output, graph, changed_outputs, changed_answers, seen=frozenset()):
+        """Whether ``output``, or any output nested in it, is rendered
+        differently after the changes"""
+        output_id = str(output._id)
+        if output_id in seen:
+            return False
+        if output_id in changed_outputs:
+            return True
+        nested_outputs, qas = graph.entities_from_html(output.html)
+        if {str(__._id) for __ in filter(None, qas)} & changed_answers:
+            return True
+        return any(
+            FormController._affected(
+                __, graph, changed_outputs, changed_answers, seen | {output_id}
+            )
+            for __ in filter(None, nested_outputs)
+        )
 
-        return Markup(questionary_compiled.safe_substitute(qa_values))
+    @staticmethod
+    def _answered_outputs(outputs, answers):
+        return {
+            _id: Markup(TemplateAnswer(html).safe_substitute(answers))
+            for _id, html in outputs.items()
+        }
+
+    @expose("json")
+    @validate(
+        {"_id": QuestionaryExistValidator(required=True)},
+        error_handler=validation_errors_response,
+    )
+    @require(
+        CanManageEntityOwner(
+            msg=l_("You are not allowed to edit this questionary."),
+            field="_id",
+            entity_model=model.Questionary,
+        )
+    )
+    def decision_graph(self, _id, **kw):
+        """The document of the questionary and its answers, for evaluating it
+        in the browser with ``KSEvaluator``"""
+        questionary = model.Questionary.query.get(_id=ObjectId(_id))
+        return dict(
+            graph=decision_graph(questionary.document),
+            answers={
+                qa_id: answer["qa_response"]
+                for qa_id, answer in questionary.qa_values.items()
+            },
+            answers_order=questionary.answers_order,
+        )
 
     @expose("json")
     @decode_params("json")
@@ -253,7 +434,17 @@ class FormController(BaseController):
             entity_model=model.Questionary,
         )
     )
-    def responde(self, _id=None, qa_id=None, qa_response=None, **kwargs):
+    def responde(
+        self,
+        _id=None,
+        qa_id=None,
+        qa_response=None,
+        delta=False,
+        evaluate=True,
+        **kwargs
+    ):
+        """Answers ``qa_id``, with ``evaluate`` False the questionary is
+        evaluated in the browser and the answer is only stored"""
         questionary = model.Questionary.query.get(_id=ObjectId(_id))
         #  Check if the qa response is valid
         qa = model.Qa.query.get(_id=ObjectId(qa_id))
@@ -267,28 +458,115 @@ class FormController(BaseController):
             if isinstance(qa_response, str):
                 qa_response = [qa_response]
 
-        if not questionary.qa_values:
-            order_number = 0
-        else:
-            order_number = 1 + max(
-                [
-                    questionary.qa_values[elem]["order_number"]
-                    for elem in questionary.qa_values
-                ]
-            )
-        questionary.qa_values[qa_id] = {
-            "qa_response": qa_response,
-            "order_number": order_number,
-        }
-        quest_compiled = questionary.evaluate_questionary
+        if not evaluate:
+            questionary.set_answer(qa_id, qa_response)
+            questionary.invalidate(qa_id)
+            return self._stored(questionary)
 
+        graph = DocumentGraph(questionary.document)
+        before = self._delta_start(questionary, graph) if delta else {}
+        questionary.set_answer(qa_id, qa_response)
+        questionary.reevaluate(qa_id, graph=graph)
+        if not questionary.save_changes():
+            return self._conflict()
+
+        if delta:
+            return self._delta(questionary, before)
         return dict(
             questionary=questionary,
-            quest_compiled=quest_compiled,
-            html=self.get_questionary_html(_id),
+            quest_compiled=questionary.evaluation,
+            html=self.questionary_html(questionary, graph),
             recap=questionary.answers,
         )
 
+    @expose("json")
+    @decode_params("json")
+    @validate(
+        {"_id": QuestionaryExistValidator(required=True)},
+        error_handler=validation_errors_response,
+    )
+    @require(
+        CanManageEntityOwner(
+            msg=l_("You are not allowed to edit this questionary."),
+            field="_id",
+            entity_model=model.Questionary,
+        )
+    )
+    def responde_many(self, _id=None, answers=None, delta=False, **kwargs):
+        """Like :meth:`responde` for many questions at once, ``answers`` maps
+        the qa ids to their response and the questionary is evaluated once"""
+        if not isinstance(answers, dict) or not answers:
+            response.status_code = 412
+            return dict(errors={"answers": _("Please provide some answers")})
+
+        qa_ids = []
+        for qa_id in answers:
+            try:
+                qa_ids.append(ObjectId(qa_id))
+            except InvalidId:
+                pass
+        qas = {str(__._id): __ for __ in model.Qa.query.find({"_id": {"$in": qa_ids}})}
+
+        for qa_id, qa_response in answers.items():
+            error = self._answer_error(qas.get(qa_id), qa_response)
+            if error:
+                # a single invalid answer rejects the whole batch
+                response.status_code = 412
+                return dict(errors={qa_id: error})
+
+        questionary = model.Questionary.query.get(_id=ObjectId(_id))
+        graph = DocumentGraph(questionary.document)
+        before = self._delta_start(questionary, graph) if delta else {}
+        for qa_id, qa_response in answers.items():
+            if qas[qa_id].type == "multi" and isinstance(qa_response, str):
+                qa_response = [qa_response]
+            questionary.set_answer(qa_id, qa_response)
+        questionary.reevaluate(*answers, graph=graph)
+        if not questionary.save_changes():
+            return self._conflict()
+
+        if delta:
+            return self._delta(questionary, before)
+        return dict(
+            questionary=questionary,
+            quest_compiled=questionary.evaluation,
+            html=self.questionary_html(questionary, graph),
+            recap=questionary.answers,
+        )
+
+    @staticmethod
+    def _answer_error(qa, qa_response):
+        """Why ``qa_response`` can't answer ``qa``, None when it can"""
+        if qa is None:
+            return _("Question does not exists")
+        if qa_response in (None, "", []):
+            return _("Please enter a value")
+        if qa.is_multi and isinstance(qa_response, list):
+            responses = qa_response
+        else:
+            responses = [qa_response]
+        if not all(isinstance(__, str) for __ in responses):
+            return _("Invalid answer")
+        if not qa.is_text and not set(responses) <= set(qa.answers):
+            return _("Invalid answer")
+
+    @classmethod
+    def _stored(cls, questionary):
+        if not questionary.save_changes():
+            return cls._conflict()
+        return dict(errors=None)
+
+    @staticmethod
+    def _conflict():
+        response.status_code = 409
+        return dict(
+            errors={
+                "qa_response": _(
+                    "The questionary was changed meanwhile, reload it to continue"
+                )
+            }
+        )
+
     @expose("ksweb.templates.questionary.completed")
     @validate(
         {"_id": QuestionaryExistValidator(required=True)},
@@ -296,13 +574,14 @@ class FormController(BaseController):
     )
     def completed(self, _id=None, workspace=None):
         questionary = model.Questionary.query.get(_id=ObjectId(_id))
-        completed = questionary.evaluate_questionary
+        graph = DocumentGraph(questionary.document)
+        completed = questionary.evaluate(graph, reset=True, persist=False)
         if not completed:
             return redirect(
                 "/questionary/compile", params=dict(quest_complited=completed)
             )
 
-        questionary_compiled = self.get_questionary_html(_id)
+        questionary_compiled = self.questionary_html(questionary, graph)
         return dict(questionary_compiled=questionary_compiled)
 
     @expose("json")
@@ -318,32 +597,38 @@ class FormController(BaseController):
             entity_model=model.Questionary,
         )
     )
-    def previous_question(self, _id=None, **kwargs):
+    def previous_question(self, _id=None, delta=False, evaluate=True, **kwargs):
         questionary = model.Questionary.query.get(_id=ObjectId(_id))
+        if not evaluate:
+            if questionary.last_answered:
+                questionary.invalidate(questionary.last_answered)
+                questionary.unset_answer(questionary.last_answered)
+            return self._stored(questionary)
+
         previous_response = {}
+        graph = DocumentGraph(questionary.document)
+        before = self._delta_start(questionary, graph) if delta else {}
 
-        if questionary.qa_values:
-            last_order_number = max(
-                [
-                    questionary.qa_values[qa_val]["order_number"]
-                    for qa_val in questionary.qa_values
-                ]
-            )
-            last_question_answered = [
-                qa_val
-                for qa_val in questionary.qa_values
-                if questionary.qa_values[qa_val]["order_number"] == last_order_number
-            ][0]
+        last_question_answered = questionary.last_answered
+        if last_question_answered:
             previous_response = questionary.qa_values[last_question_answered][
                 "qa_response"
             ]
-            questionary.qa_values.pop(last_question_answered, None)
-            DBSession.flush_all()
+            questionary.unset_answer(last_question_answered)
+            questionary.reevaluate(last_question_answered, graph=graph)
+        else:
+            questionary.evaluate(graph)
+        if not questionary.save_changes():
+            return self._conflict()
 
+        if delta:
+            return dict(
+                self._delta(questionary, before), previous_response=previous_response
+            )
         return dict(
             questionary=questionary,
-            quest_compiled=questionary.evaluate_questionary,
-            html=self.get_questionary_html(_id),
+            quest_compiled=questionary.evaluation,
+            html=self.questionary_html(questionary, graph),
             previous_response=previous_response,
             recap=questionary.answers,
         )
@@ -2,7 +2,7 @@
 
 import tg
 from bson import ObjectId
-from ksweb.lib.utils import to_object_id, find_entities_from_html, hash_to_id
+from ksweb.lib.utils import to_object_id, find_entities_from_html, resolve_ids
 from tg import expose, validate, validation_errors_response, RestController, decode_params, request, tmpl_context, \
     response, session, flash, redirect
 from tg import predicates
@@ -23,7 +23,8 @@ class OutputController(RestController):
 
         _filter = Precondition.query.get(_id=ObjectId(precondition))
         __, answers_hashes = find_entities_from_html(html)
-        answers = [hash_to_id(h, Qa) for h in answers_hashes]
+        ids = resolve_ids(answers_hashes, Qa)
+        answers = [ids.get(h, h) for h in answers_hashes]
         problematic = set(answers) - set(_filter.response_interested)
         if len(problematic):
             response.status_code = 412
@@ -194,8 +195,8 @@ class OutputController(RestController):
     @expose('json')
     def get_related_entities(self, _id):
         o = Output.by_id(_id)
-        output_related = Output.query.find({'$text': {'$search': o.hash}}).all()
-        documents_related = Document.query.find({'$text': {'$search': o.hash}}).all()
+        output_related = Output.query.find({'refs': o._id}).all()
+        documents_related = Document.query.find({'refs': o._id}).all()
         entities = list(output_related + documents_related)
         return dict(entities=entities, len=len(entities))
 
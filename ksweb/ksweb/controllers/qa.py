@@ -181,7 +181,7 @@ class QaController(RestController):
         :param _id:
         :return:
         """
-        entities = Precondition.query.find({'type': Precondition.TYPES.SIMPLE, 'condition': ObjectId(_id)}).all()
+        entities = Precondition.query.find({'type': Precondition.TYPES.SIMPLE, 'refs': ObjectId(_id)}).all()
         return {
             'entities': entities,
             'len': len(entities)
@@ -119,7 +119,8 @@ class ResolveController(BaseController):
         for obj in to_edit:
             entity = entity_from_id(obj['_id'])
             if obj_to_clone['entity'] == 'output':
-                entity.html = entity.html.replace(obj_to_clone['hash'], str(new_obj.hash))
+                entity.html = entity.html.replace(obj_to_clone['_id'], str(new_obj._id))
+                entity.html = entity.html.replace(obj_to_clone['hash'], str(new_obj._id))
             elif obj_to_clone['entity'] in ['precondition/simple', 'precondition/advanced']:
                 if entity.entity == 'qa' and entity._parent_precondition == old_obj_id:
                     entity._parent_precondition = new_obj._id
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""Precondition compiler.
+
+Turns a :class:`ksweb.model.Precondition` tree into a tree of plain python
+objects that can be evaluated many times against the answers of a
+questionary without generating and ``eval``-ing python source code.
+"""
+import hashlib
+import json
+
+import numpy as np
+from bson import ObjectId
+from repoze.lru import LRUCache
+
+from ksweb import model
+from ksweb.lib.graph import DocumentGraph, EntityLookup
+from ksweb.lib.utils import replace_placeholders
+
+
+class _Node(object):
+    """Nodes are evaluated with Kleene three-valued logic: ``None`` is an
+    unknown value, ``and`` and ``or`` are decided as soon as one of the
+    operands decides them, whatever the position of the unknown operand."""
+    qa_ids = frozenset()
+    """Ids of the questions the node depends on"""
+
+    def plan(self, answers):
+        """Returns the value of the node, ``None`` when it is not decided yet,
+        together with the ordered list of the questions that are still reachable"""
+        raise NotImplementedError
+
+    def tree(self):
+        """JSON serializable form of the node, ``[operator, *operands]``"""
+        raise NotImplementedError
+
+    def column(self, columns, size):
+        """Values of the node for ``size`` questionaries at once, as two boolean
+        arrays: the value and whether it is known. ``columns`` are the
+        categorical answers of each question, see :func:`bulk_evaluate`"""
+        raise NotImplementedError
+
+
+class _Always(_Node):
+    """Outputs without a filter are always shown"""
+    def plan(self, answers):
+        return True, []
+
+    def tree(self):
+        return True
+
+    def column(self, columns, size):
+        return np.ones(size, dtype=bool), np.ones(size, dtype=bool)
+
+    def __str__(self):
+        return '()'
+
+
+class _Leaf(_Node):
+    def __init__(self, qa_id, value=None):
+        self.qa_id = qa_id
+        self.value = value
+        self.qa_ids = frozenset([qa_id])
+
+    def plan(self, answers):
+        if self.qa_id not in answers:
+            return None, [self.qa_id]
+        return self.test(answers[self.qa_id]), []
+
+    def column(self, columns, size):
+        if self.qa_id not in columns:
+            return np.zeros(size, dtype=bool), np.zeros(size, dtype=bool)
+        codes, categories = columns[self.qa_id]
+        # each distinct response is tested once, the last item is for the missing ones
+        tested = np.array([self.test(__) for __ in categories] + [False], dtype=bool)
+        return tested[codes], codes >= 0
+
+    def test(self, response):
+        raise NotImplementedError
+
+
+class _Answered(_Leaf):
+    def test(self, response):
+        return response != ''
+
+    def tree(self):
+        return ['answered', self.qa_id]
+
+    def __str__(self):
+        return "q_%s != ''" % self.qa_id
+
+
+class _Equals(_Leaf):
+    def test(self, response):
+        return response == self.value
+
+    def tree(self):
+        return ['eq', self.qa_id, self.value]
+
+    def __str__(self):
+        return "q_%s == %r" % (self.qa_id, self.value)
+
+
+class _Contains(_Leaf):
+    def test(self, response):
+        return self.value in response
+
+    def tree(self):
+        return ['in', self.qa_id, self.value]
+
+    def __str__(self):
+        return "%r in q_%s" % (self.value, self.qa_id)
+
+
+class _Not(_Node):
+    def __init__(self, operand):
+        self.operand = operand
+        self.qa_ids = operand.qa_ids
+
+    def plan(self, answers):
+        value, questions = self.operand.plan(answers)
+        return (None if value is None else not value), questions
+
+    def tree(self):
+        return ['not', self.operand.tree()]
+
+    def column(self, columns, size):
+        value, known = self.operand.column(columns, size)
+        return ~value & known, known
+
+    def __str__(self):
+        return 'not ( %s )' % self.operand
+
+
+class _And(_Node):
+    def __init__(self, left, right):
+        self.left, self.right = left, right
+        self.qa_ids = left.qa_ids | right.qa_ids
+
+    def plan(self, answers):
+        left, left_questions = self.left.plan(answers)
+        right, right_questions = self.right.plan(answers)
+        if left is False or right is False:
+            return False, []
+        if left and right:
+            return True, []
+        return None, left_questions + right_questions
+
+    def tree(self):
+        return ['and', self.left.tree(), self.right.tree()]
+
+    def column(self, columns, size):
+        left, left_known = self.left.column(columns, size)
+        right, right_known = self.right.column(columns, size)
+        true = left & right
+        false = (~left & left_known) | (~right & right_known)
+        return true, true | false
+
+    def __str__(self):
+        return '( %s ) and ( %s )' % (self.left, self.right)
+
+
+class _Or(_Node):
+    def __init__(self, left, right):
+        self.left, self.right = left, right
+        self.qa_ids = left.qa_ids | right.qa_ids
+
+    def plan(self, answers):
+        left, left_questions = self.left.plan(answers)
+        right, right_questions = self.right.plan(answers)
+        if left or right:
+            return True, []
+        if left is False and right is False:
+            return False, []
+        return None, left_questions + right_questions
+
+    def tree(self):
+        return ['or', self.left.tree(), self.right.tree()]
+
+    def column(self, columns, size):
+        left, left_known = self.left.column(columns, size)
+        right, right_known = self.right.column(columns, size)
+        true = left | right
+        false = ~left & left_known & ~right & right_known
+        return true, true | false
+
+    def __str__(self):
+        return '( %s ) or ( %s )' % (self.left, self.right)
+
+
+class CompiledPrecondition(object):
+    """Reusable evaluator of a precondition.
+
+    ``answers`` is a dictionary ``{qa_id: qa_response}`` of the questions answered so far.
+
+    A precondition depends only on the answers to its own questions, so its
+    results are memoized by :func:`dependencies_key` and by those answers,
+    and questionaries of the same document share them.
+    """
+    def __init__(self, key, root):
+        self.key = key
+        self.root = root
+        self.expression = str(root)
+        self._qa_ids = sorted(root.qa_ids)
+
+    def plan(self, answers):
+        key = (self.key, tuple(_hashable(answers.get(qa_id, _MISSING)) for qa_id in self._qa_ids))
+        result = _results.get(key)
+        if result is None:
+            value, questions = self.root.plan(answers)
+            result = value, tuple(questions)
+            _results.put(key, result)
+        value, questions = result
+        return value, list(questions)
+
+    def evaluate(self, answers):
+        """``True`` or ``False``, ``None`` when some answers are still needed"""
+        value, __ = self.plan(answers)
+        return value
+
+    __call__ = evaluate
+
+    def column(self, columns, size):
+        return self.root.column(columns, size)
+
+    @property
+    def qa_ids(self):
+        return self.root.qa_ids
+
+    @property
+    def tree(self):
+        return self.root.tree()
+
+    def __str__(self):
+        return self.expression
+
+
+ALWAYS = CompiledPrecondition('always', _Always())
+
+_compiled = LRUCache(1024)
+_results = LRUCache(8192)
+_MISSING = object()
+
+
+def _hashable(response):
+    # answers of multiple choice questions are lists
+    if isinstance(response, list):
+        return tuple(response)
+    return response
+
+
+def compile_precondition(precondition, lookup=None):
+    """Compile a precondition, compiled preconditions are cached by :func:`dependencies_key`.
+
+    Nested preconditions and questions are resolved through ``lookup``,
+    usually the :class:`ksweb.lib.graph.DocumentGraph` of the document.
+    """
+    if not precondition:
+        return ALWAYS
+
+    lookup = lookup or EntityLookup()
+    key = dependencies_key(precondition, lookup)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = CompiledPrecondition(key, _compile(precondition, lookup))
+        _compiled.put(key, compiled)
+    return compiled
+
+
+def dependencies_key(precondition, lookup):
+    """Digest of the hashes of ``precondition`` and of the preconditions and
+    questions it references, transitively.
+
+    Editing any of them changes the key, so cached compilations and results
+    are never reused for a changed filter, whichever process changed it.
+    """
+    hashes, seen, pending = [], set(), [precondition]
+    while pending:
+        precondition = pending.pop()
+        if precondition is None or precondition._id in seen:
+            continue
+        seen.add(precondition._id)
+        hashes.append(precondition.hash)
+        if precondition.is_simple:
+            qa = lookup.qa_by_id(precondition.condition[0])
+            if qa is None:
+                continue
+            hashes.append(qa.hash)
+            if qa._parent_precondition:
+                pending.append(lookup.precondition(qa._parent_precondition))
+        else:
+            pending.extend(lookup.precondition(ObjectId(__)) for __ in precondition.condition
+                           if __ not in model.Precondition.PRECONDITION_OPERATOR)
+    state = json.dumps(sorted(hashes, key=str))
+    return hashlib.blake2b(state.encode(), digest_size=16).hexdigest()
+
+
+def decision_graph(document, graph=None):
+    """The compiled ``document`` as plain data, for evaluating it elsewhere.
+
+    Outputs and questions are keyed by id like the placeholders of the html,
+    filters are trees of :meth:`_Node.tree` referencing questions by id
+    like the answers of a questionary.
+    """
+    graph = graph or DocumentGraph(document)
+
+    def _id(entity):
+        return lambda placeholder: str(entity(placeholder)._id) if entity(placeholder) else placeholder
+
+    def _html(html):
+        return replace_placeholders(html, _id(graph.output), _id(graph.qa))
+
+    outputs, qas = {}, {}
+    for entity in graph.entities:
+        if isinstance(entity, model.Output):
+            precondition = graph.precondition(entity._precondition)
+            outputs[str(entity._id)] = dict(
+                html=_html(entity.html),
+                condition=compile_precondition(precondition, graph).tree,
+            )
+        elif isinstance(entity, model.Qa):
+            qas[str(entity._id)] = dict(
+                id=str(entity._id),
+                question=entity.question,
+                tooltip=entity.tooltip,
+                link=entity.link,
+                type=entity.type,
+                answers=list(entity.answers or []),
+            )
+    return dict(hash=document.hash, html=_html(document.html), outputs=outputs, qas=qas)
+
+
+def bulk_evaluate(document, questionaries=None, graph=None):
+    """Outputs of ``document`` shown by each of ``questionaries`` at once.
+
+    ``questionaries`` defaults to all the questionaries of the document,
+    read without loading them as :class:`ksweb.model.Questionary`. The
+    answers become one categorical numpy column per question, the codes of
+    the responses with -1 for the missing ones, and each filter is
+    evaluated with array operations on whole columns, so every filter is
+    compiled and walked only once for the population.
+
+    Returns the ids of the questionaries, the ids of the outputs and the
+    boolean inclusion matrix, one row per questionary and one column per
+    output: an output is included when its filter holds and, if nested, one
+    of the outputs it is nested in is included. Outputs still waiting for
+    answers are not included.
+    """
+    graph = graph or DocumentGraph(document)
+    if questionaries is None:
+        from ming.odm import mapper
+        collection = mapper(model.Questionary).collection.m.collection
+        rows = [(__['_id'], __.get('qa_values') or {})
+                for __ in collection.find({'_document': document._id}, {'qa_values': 1})]
+    else:
+        rows = [(__._id, __.qa_values) for __ in questionaries]
+    size = len(rows)
+
+    outputs = [__ for __ in graph.entities if isinstance(__, model.Output)]
+    compiled = {str(__._id): compile_precondition(graph.precondition(__._precondition), graph)
+                for __ in outputs}
+    qa_ids = set().union(*(__.qa_ids for __ in compiled.values()))
+    columns = {qa_id: _categorical([values[qa_id]['qa_response'] if qa_id in values else _MISSING
+                                    for __, values in rows])
+               for qa_id in qa_ids}
+    filters = {}
+    for output_id, __ in compiled.items():
+        value, known = __.column(columns, size)
+        filters[output_id] = value & known
+
+    included = {str(__._id): np.zeros(size, dtype=bool) for __ in outputs}
+
+    def include(output, shown_parent, path):
+        output_id = str(output._id)
+        if output_id in path:
+            return
+        shown = shown_parent & filters[output_id]
+        included[output_id] |= shown
+        nested_outputs, __ = graph.entities_from_html(output.html)
+        for nested in filter(None, nested_outputs):
+            include(nested, shown, path | {output_id})
+
+    for output in filter(None, graph.outputs):
+        include(output, np.ones(size, dtype=bool), frozenset())
+
+    outputs_ids = sorted(included)
+    return dict(
+        questionaries=[str(_id) for _id, __ in rows],
+        outputs=outputs_ids,
+        matrix=np.column_stack([included[__] for __ in outputs_ids]) if outputs_ids
+        else np.zeros((size, 0), dtype=bool),
+    )
+
+
+def _categorical(responses):
+    """Codes of ``responses`` and the distinct responses they refer to"""
+    categories, codes = {}, []
+    for response in responses:
+        if response is _MISSING:
+            codes.append(-1)
+        else:
+            codes.append(categories.setdefault(_hashable(response), len(categories)))
+    # multiple choice answers are tested as lists, like in the questionaries
+    distinct = [list(__) if isinstance(__, tuple) else __ for __ in categories]
+    return np.array(codes, dtype=np.intp), distinct
+
+
+def _compile(precondition, lookup):
+    if precondition.is_simple:
+        return _compile_simple(precondition, lookup)
+    return _AdvancedParser(precondition.condition, lookup).parse()
+
+
+def _compile_simple(precondition, lookup):
+    qa = lookup.qa_by_id(precondition.condition[0])
+    qa_id, value = str(precondition.condition[0]), precondition.condition[1]
+    if value == '':
+        node = _Answered(qa_id)
+    elif qa.is_multi:
+        node = _Contains(qa_id, value)
+    else:
+        node = _Equals(qa_id, value)
+
+    if qa._parent_precondition:
+        return _And(compile_precondition(lookup.precondition(qa._parent_precondition), lookup).root, node)
+    return node
+
+
+class _AdvancedParser(object):
+    """Recursive descent parser of advanced conditions, it follows the python
+    precedence of the operators: ``not`` binds tighter than ``and`` that
+    binds tighter than ``or``"""
+    def __init__(self, condition, lookup):
+        self.tokens = list(condition)
+        self.lookup = lookup
+        self.position = 0
+
+    def parse(self):
+        node = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError('Unexpected token %r in condition' % self._peek())
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == 'or':
+            self._next()
+            node = _Or(node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == 'and':
+            self._next()
+            node = _And(node, self._not())
+        return node
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._next()
+            return _Not(self._not())
+        return self._operand()
+
+    def _operand(self):
+        token = self._next()
+        if token == '(':
+            node = self._or()
+            if self._next() != ')':
+                raise ValueError('Unbalanced parenthesis in condition')
+            return node
+        if token is None or token in model.Precondition.PRECONDITION_OPERATOR:
+            raise ValueError('Unexpected token %r in condition' % token)
+        return compile_precondition(self.lookup.precondition(ObjectId(token)), self.lookup).root
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Conversion of compiled questionaries through pandoc.
+
+Conversions run in a bounded pool, at most ``export.max_processes`` pandoc
+processes at once while the other requests wait their turn, and the
+artifacts are stored in ``export.cache_dir`` named after the hash of the
+markdown and of the target format, so an unchanged questionary is converted
+only once. Each new artifact prunes the directory: files not used for
+``export.max_age`` seconds are removed, then the least recently used ones
+while it is larger than ``export.max_size`` bytes.
+
+The name of an artifact is also the id of the job producing it: requests
+can :func:`submit` a conversion without waiting for it and poll its
+:func:`status`. The state of the jobs not done yet is kept next to their
+artifact, in ``<job>.pending`` and ``<job>.failed`` marker files, so every
+process sharing ``export.cache_dir`` reports it. Names start with the
+``scope`` of the conversion, the questionary requesting it, so
+:func:`job_scope` tells who a job belongs to.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pypandoc
+import tg
+from webob import Response
+from webob.dec import wsgify
+from webob.static import BLOCK_SIZE, FileIter
+
+_lock = threading.RLock()
+_pool = None
+_converting = {}
+_job_id = re.compile(r'^(?:(\w+)-)?[0-9a-f]{32}\.(\w+)$')
+
+FORMATS = ('docx', 'markdown', 'odt')
+MAX_AGE = 7 * 24 * 60 * 60
+MAX_SIZE = 1024 ** 3
+PENDING_TIMEOUT = 10 * 60
+
+
+def artifact_key(markdown, format):
+    return hashlib.blake2b('\0'.join([format, markdown]).encode(), digest_size=16).hexdigest()
+
+
+def cache_dir():
+    path = tg.config.get('export.cache_dir') or os.path.join(
+        tg.config.get('cache_dir') or tempfile.gettempdir(), 'exports')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def artifact_path(markdown, format, scope=None):
+    if format not in FORMATS:
+        raise ValueError('Unsupported format %r' % format)
+    name = '%s.%s' % (artifact_key(markdown, format), format)
+    if scope:
+        name = '%s-%s' % (scope, name)
+    return os.path.join(cache_dir(), name)
+
+
+def job_id(path):
+    return os.path.basename(path)
+
+
+def job_path(job):
+    """Path of the artifact of ``job``, None when it is not a valid job id"""
+    match = _job_id.match(job or '')
+    if not match or match.group(2) not in FORMATS:
+        return None
+    return os.path.join(cache_dir(), job)
+
+
+def job_scope(job):
+    """Scope the artifact of ``job`` was converted for, None when it has none"""
+    match = _job_id.match(job or '')
+    return match.group(1) if match else None
+
+
+def status(job):
+    path = job_path(job)
+    if path is None:
+        return 'unknown'
+    if os.path.exists(path):
+        return 'done'
+    with _lock:
+        future = _converting.get(path)
+    if future is not None:
+        return 'running' if future.running() else 'queued'
+    if os.path.exists(path + '.failed'):
+        return 'failed'
+    try:
+        with open(path + '.pending') as f:
+            state = f.read()
+        changed = os.stat(path + '.pending').st_mtime
+    except FileNotFoundError:
+        return 'unknown'
+    # the process converting it died, it is never going to be done
+    timeout = int(tg.config.get('export.pending_timeout') or PENDING_TIMEOUT)
+    if time.time() - changed > timeout:
+        return 'failed'
+    return state or 'queued'
+
+
+def serve(path, filename):
+    """Response sending the artifact at ``path`` as the ``filename`` attachment.
+
+    Whole files go to the server through ``wsgi.file_wrapper`` when available,
+    ranges are read seeking the file; the name of the artifact is a hash of
+    its content, so it is also its ETag.
+    """
+    @wsgify
+    def app(req):
+        stat = os.stat(path)
+        f = open(path, 'rb')
+        if req.range is None and 'wsgi.file_wrapper' in req.environ:
+            app_iter = req.environ['wsgi.file_wrapper'](f, BLOCK_SIZE)
+        else:
+            app_iter = FileIter(f)
+        return Response(
+            app_iter=app_iter,
+            content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            content_length=stat.st_size,
+            content_disposition='attachment;filename=%s' % filename,
+            last_modified=stat.st_mtime,
+            etag=job_id(path),
+            accept_ranges='bytes',
+            conditional_response=True,
+        )
+    return tg.use_wsgi_app(app)
+
+
+def pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            max_processes = int(tg.config.get('export.max_processes') or os.cpu_count() or 1)
+            _pool = ThreadPoolExecutor(max_workers=max_processes, thread_name_prefix='pandoc')
+        return _pool
+
+
+def submit(markdown, format, scope=None):
+    """Schedules the conversion of ``markdown`` to ``format``.
+
+    Returns a future resolving to the path of the artifact, the same future
+    is shared by the requests converting the same content meanwhile.
+    """
+    path = artifact_path(markdown, format, scope)
+    with _lock:
+        future = _converting.get(path)
+        if future is None:
+            _mark(path + '.pending', 'queued')
+            _remove(path + '.failed')
+            future = _converting[path] = pool().submit(_convert, markdown, format, path)
+            future.add_done_callback(lambda f: _forget(path, f))
+    return future
+
+
+def convert(markdown, format, scope=None):
+    """Path of the ``markdown`` converted to ``format``, pandoc runs only on a cache miss"""
+    path = artifact_path(markdown, format, scope)
+    if os.path.exists(path):
+        _touch(path)
+        return path
+    return submit(markdown, format, scope).result()
+
+
+def _forget(path, future):
+    with _lock:
+        if _converting.get(path) is future:
+            del _converting[path]
+
+
+def _mark(marker, state=''):
+    with open(marker, 'w') as f:
+        f.write(state)
+
+
+def _convert(markdown, format, path):
+    try:
+        if not os.path.exists(path):
+            _mark(path + '.pending', 'running')
+            _pandoc(markdown, format, path)
+            prune(os.path.dirname(path))
+    except Exception:
+        _mark(path + '.failed')
+        raise
+    finally:
+        _remove(path + '.pending')
+    return path
+
+
+def _pandoc(markdown, format, path):
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.' + format)
+    os.close(fd)
+    try:
+        pypandoc.convert_text(markdown, format, format='md', outputfile=partial)
+        # readers never see a half written artifact
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def prune(directory=None, now=None):
+    """Removes the artifacts unused for too long, then the least recently
+    used ones until the cache fits its size"""
+    max_age = int(tg.config.get('export.max_age') or MAX_AGE)
+    max_size = int(tg.config.get('export.max_size') or MAX_SIZE)
+    now = now or time.time()
+    files = []
+    for entry in os.scandir(directory or cache_dir()):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if now - stat.st_mtime > max_age:
+            _remove(entry.path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(__[1] for __ in files)
+    for __, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        _remove(path)
+        size -= file_size
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove(path):
+    # another process may be pruning too
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
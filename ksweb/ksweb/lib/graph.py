@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Document graph loader.
+
+A document references its outputs with ``#{_id}`` placeholders, outputs
+reference nested outputs and questions with ``#{_id}`` and ``@{_id}``,
+content written before placeholders held ids references them by hash.
+Outputs and questions are filtered by preconditions that reference other
+preconditions and questions by ``_id``. :class:`DocumentGraph` loads all of
+them level by level, with one ``$in`` query per collection per level,
+:class:`PreconditionGraph` does the same starting from a precondition.
+"""
+from bson import ObjectId
+
+from ksweb import model
+from ksweb.lib.utils import find_entities_from_html, get_entities_from_str
+from ksweb.model.mapped_entity import placeholders_query
+
+
+class EntityLookup(object):
+    """Resolves the entities of a document querying the database for each of them"""
+
+    def output(self, placeholder):
+        return model.Output.by_placeholder(placeholder)
+
+    def output_by_id(self, _id):
+        return model.Output.query.get(_id=ObjectId(_id))
+
+    def qa(self, placeholder):
+        return model.Qa.by_placeholder(placeholder)
+
+    def qa_by_id(self, _id):
+        return model.Qa.query.get(_id=ObjectId(_id))
+
+    def precondition(self, _id):
+        if not _id:
+            return None
+        return model.Precondition.query.get(_id=ObjectId(_id))
+
+    def entities_from_html(self, html):
+        # one query per collection, like the graphs do for each level
+        return get_entities_from_str(html)
+
+
+class DocumentGraph(EntityLookup):
+    """In memory graph of all the entities a document is made of.
+
+    Lookups of entities that are not part of the document fall back to the database.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._outputs = {}
+        self._qas = {}
+        self._ids = {}
+        outputs_placeholders, qas_placeholders = find_entities_from_html(document.html)
+        self._load(set(outputs_placeholders), set(qas_placeholders))
+
+    @property
+    def entities(self):
+        return set(self._ids.values())
+
+    @property
+    def outputs(self):
+        """The outputs of the document, in order of appearance"""
+        outputs, __ = self.entities_from_html(self.document.html)
+        return outputs
+
+    def output(self, placeholder):
+        return self._outputs.get(placeholder) or super().output(placeholder)
+
+    def output_by_id(self, _id):
+        return self._ids.get(str(_id)) or super().output_by_id(_id)
+
+    def qa(self, placeholder):
+        return self._qas.get(placeholder) or super().qa(placeholder)
+
+    def qa_by_id(self, _id):
+        return self._ids.get(str(_id)) or super().qa_by_id(_id)
+
+    def precondition(self, _id):
+        if not _id:
+            return None
+        return self._ids.get(str(_id)) or super().precondition(_id)
+
+    def entities_from_html(self, html):
+        outputs, answers = find_entities_from_html(html)
+        return [self.output(__) for __ in outputs], [self.qa(__) for __ in answers]
+
+    def hash_for_id(self, _id):
+        """Like :func:`ksweb.lib.utils.id_to_hash`, returns ``_id`` itself when it is not an entity"""
+        entity = self._ids.get(str(_id))
+        return entity.hash if entity else _id
+
+    def _load(self, outputs_placeholders, qas_placeholders, preconditions_ids=()):
+        qas_ids, preconditions_ids = set(), set(preconditions_ids)
+
+        while outputs_placeholders or qas_placeholders or qas_ids or preconditions_ids:
+            outputs = self._fetch(model.Output, **placeholders_query(outputs_placeholders)) \
+                if outputs_placeholders else []
+            qas_placeholders.update(str(__) for __ in qas_ids)
+            qas = self._fetch(model.Qa, **placeholders_query(qas_placeholders)) if qas_placeholders else []
+            preconditions = self._fetch(model.Precondition, _id={'$in': list(preconditions_ids)}) \
+                if preconditions_ids else []
+
+            outputs_placeholders, qas_placeholders, qas_ids, preconditions_ids = set(), set(), set(), set()
+            for o in outputs:
+                for __ in o.placeholders:
+                    self._outputs.setdefault(__, o)
+                nested, answers = find_entities_from_html(o.html)
+                outputs_placeholders.update(nested)
+                qas_placeholders.update(answers)
+                if o._precondition:
+                    preconditions_ids.add(o._precondition)
+            for qa in qas:
+                for __ in qa.placeholders:
+                    self._qas.setdefault(__, qa)
+                if qa._parent_precondition:
+                    preconditions_ids.add(qa._parent_precondition)
+            for p in preconditions:
+                if p.is_simple:
+                    qas_ids.add(ObjectId(p.condition[0]))
+                else:
+                    preconditions_ids.update(ObjectId(__) for __ in p.condition
+                                             if __ not in model.Precondition.PRECONDITION_OPERATOR)
+
+            outputs_placeholders -= set(self._outputs)
+            qas_placeholders -= set(self._qas)
+            qas_ids = {__ for __ in qas_ids if str(__) not in self._ids}
+            preconditions_ids = {__ for __ in preconditions_ids if str(__) not in self._ids}
+
+    def _fetch(self, cls, **query):
+        found = cls.query.find(query).all()
+        for __ in found:
+            self._ids[str(__._id)] = __
+        return found
+
+
+class PreconditionGraph(DocumentGraph):
+    """In memory graph of a precondition and of the preconditions and
+    questions it depends on, it has no document nor outputs"""
+
+    def __init__(self, precondition):
+        self.document = None
+        self._outputs = {}
+        self._qas = {}
+        self._ids = {}
+        self._load(set(), set(), {precondition._id})
@@ -4,7 +4,7 @@ import logging
 
 from bson import ObjectId
 from kajiki import XMLTemplate
-from ksweb.lib.utils import id_to_hash, entity_from_id
+from ksweb.lib.utils import id_to_hash, resolve_hashes
 from ksweb.model.mapped_entity import MappedEntity
 from markupsafe import Markup
 from datetime import datetime
@@ -147,5 +147,4 @@ def dependencies(entity):
 
 
 def i2h(_id):
-    e = entity_from_id(_id)
-    return e.hash
+    return resolve_hashes([_id])[str(_id)]
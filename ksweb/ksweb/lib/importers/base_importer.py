@@ -39,10 +39,10 @@ class BaseImporter(object):
         os, qas = find_entities_from_html(o.get('html'))
         for nested_output in os:
             new_output = self.__import_output(nested_output)
-            o['html'] = o['html'].replace(nested_output, new_output.hash)
+            o['html'] = o['html'].replace(nested_output, str(new_output._id))
         for qa in qas:
             new_qa = self.__import_qa(qa)
-            o['html'] = o['html'].replace(qa, new_qa.hash)
+            o['html'] = o['html'].replace(qa, str(new_qa._id))
         return self.__upsert_document(Output, oid, o)
 
     def __import_filter(self, fid):
@@ -99,7 +99,7 @@ class BaseImporter(object):
         return new_entity
 
     def __upsert_document(self, cls, _id, body):
-        filter_out = ['_id', 'entity', 'auto_generated', 'status', 'hash']
+        filter_out = ['_id', 'entity', 'auto_generated', 'status', 'hash', 'refs']
         body = {k: v for k, v in body.items() if k not in filter_out}
         found = self.__find_stored_entity(cls, _id, body)
         if found:
@@ -113,7 +113,7 @@ class BaseImporter(object):
         html = self.to_be_imported['html']
         for old, new in self.converted.items():
             if old in html:
-                html = html.replace(old, (Output.query.get(ObjectId(new))).hash)
+                html = html.replace(old, new)
         document_args = dict(
             html=html,
             _owner=self.owner,
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Rendering of the outputs of a questionary."""
+import hashlib
+import json
+
+from repoze.lru import LRUCache
+
+from markupsafe import Markup
+from ksweb import model
+from ksweb.lib.graph import EntityLookup
+from ksweb.lib.utils import TemplateOutput
+
+_rendered = LRUCache(256)
+
+
+class RenderContext(object):
+    """State of a single render.
+
+    Entities are resolved through ``graph`` and each output is rendered only
+    once, even when it is nested in many places of the document.
+    """
+
+    def __init__(self, evaluations_dict, graph=None):
+        self.evaluations = evaluations_dict
+        self.graph = graph or EntityLookup()
+        self._rendered = {}
+
+    def evaluation(self, output):
+        return self.evaluations.get(str(output._id), {}).get('evaluation')
+
+    def render(self, output):
+        key = (str(output._id), self.evaluation(output))
+        if key not in self._rendered:
+            self._rendered[key] = self._render(output)
+        return self._rendered[key]
+
+    def _render(self, output):
+        if str(output._id) not in self.evaluations:
+            return ''
+        if self.evaluation(output) is False:
+            return ''
+
+        # like in the document, placeholders of the outputs not shown are left in place
+        nested_outputs, __ = self.graph.entities_from_html(output.html)
+        nested_output_html = {str(__._id): self.render(__) for __ in filter(None, nested_outputs)
+                              if self.evaluation(__)}
+        return TemplateOutput(output.html).safe_substitute(nested_output_html)
+
+
+def questionary_fragments(questionary, graph, only=None):
+    """Pieces the compiled html of ``questionary`` is made of.
+
+    Returns the rendered outputs of the document keyed by id, the outputs
+    not shown are missing as their placeholder is left in place, and the
+    escaped answers keyed by the id of their question. With ``only`` just
+    the outputs with those ids are rendered.
+    """
+    context = RenderContext(questionary.output_values, graph)
+    outputs = {str(__._id): context.render(__) for __ in filter(None, graph.outputs)
+               if (only is None or str(__._id) in only) and context.evaluation(__)}
+    answers = {qa_id: Markup.escape(resp['qa_response'])
+               for qa_id, resp in questionary.qa_values.items()}
+    return outputs, answers
+
+
+def render_key(graph, qa_values):
+    """Digest of everything the compiled html of a questionary depends on.
+
+    Any edit of an entity of the document changes its hash, so the key of
+    the document graph changes too; ``output_values`` are left out as they
+    are derived from the graph and the answers.
+    """
+    hashes = sorted(__.hash for __ in graph.entities)
+    state = json.dumps([graph.document.hash, hashes, qa_values], sort_keys=True, default=str)
+    return hashlib.blake2b(state.encode(), digest_size=16).hexdigest()
+
+
+def cached_render(key, render):
+    """Looks up ``key`` in the process LRU, then in the shared
+    :class:`ksweb.model.RenderCache`, and calls ``render`` only on a miss of both."""
+    html = _rendered.get(key)
+    if html is None:
+        html = model.RenderCache.get(key)
+        if html is None:
+            html = render()
+            if html is None:
+                return None
+            model.RenderCache.put(key, str(html))
+        _rendered.put(key, html)
+    return html
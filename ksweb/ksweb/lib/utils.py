@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import re
 from string import Template
 from bson import ObjectId
 from bson.errors import InvalidId
 from ksweb.model import Output, Precondition, Qa, Document
+from ksweb.model.mapped_entity import placeholders_query
 from markupsafe import Markup
+from ming.odm import mapper
+from repoze.lru import LRUCache
+import tg
 from tg.util.ming import dictify
 from ksweb import model
 
@@ -11,21 +16,53 @@ from ksweb import model
 # https://stackoverflow.com/questions/34360603/python-template-safe-substitution-with-the-custom-double-braces-format
 class TemplateOutput(Template):
     delimiter = '#'
+    # placeholders hold ids, that may start with a digit
+    braceidpattern = r'(?a:[_a-z0-9]+)'
 
 
 class TemplateAnswer(Template):
     delimiter = '@'
+    braceidpattern = r'(?a:[_a-z0-9]+)'
+
+
+_placeholder = re.compile(r'([#@]){([^\W]+)\b}')
 
 
 def find_entities_from_html(html):
     if not html:
         return [], []
-    import re
     outputs_hashes = re.findall(r'#{([^\W]+)\b}', html)
     answers_hashes = re.findall(r'@{([^\W]+)\b}', html)
     return outputs_hashes, answers_hashes
 
 
+def replace_placeholders(html, output, qa):
+    """Rewrites what the ``#{}`` and ``@{}`` placeholders of ``html`` hold
+    with the result of ``output`` and ``qa`` respectively"""
+    if not html:
+        return html
+
+    def _replace(match):
+        kind, placeholder = match.groups()
+        return '%s{%s}' % (kind, (output if kind == '#' else qa)(placeholder))
+    return _placeholder.sub(_replace, html)
+
+
+def stable_placeholders(html):
+    """``html`` with the placeholders that hold a hash rewritten to hold the id of the entity.
+
+    Ids never change, so editing an entity does not affect the content
+    referencing it. Entities are looked up out of the session, so that it
+    can be used while the session is flushing.
+    """
+    outputs, qas = find_entities_from_html(html)
+    outputs = model.Output.ids_by_hash([__ for __ in outputs if not ObjectId.is_valid(__)])
+    qas = model.Qa.ids_by_hash([__ for __ in qas if not ObjectId.is_valid(__)])
+    if not outputs and not qas:
+        return html
+    return replace_placeholders(html, lambda __: str(outputs.get(__, __)), lambda __: str(qas.get(__, __)))
+
+
 def to_object_id(s):
     return ObjectId(s) if s else None
 
@@ -63,30 +100,38 @@ def upsert_document(cls, **body):
 
 
 def get_related_entities_for_filters(_id):
-    outputs_related = model.Output.query.find({'_precondition': ObjectId(_id)}).all()
-    preconditions_related = model.Precondition.query.find({'type': 'advanced', 'condition': ObjectId(_id)}).all()
-    qas_related = model.Qa.query.find({"_parent_precondition": ObjectId(_id)}).all()
+    outputs_related = model.Output.query.find({'refs': ObjectId(_id)}).all()
+    preconditions_related = model.Precondition.query.find({'refs': ObjectId(_id)}).all()
+    qas_related = model.Qa.query.find({'refs': ObjectId(_id)}).all()
     entities = list(outputs_related + preconditions_related + qas_related)
     return dict(entities=entities, len=len(entities))
 
 
 def get_entities_from_str(html):
     outputs_ids, answers_ids = find_entities_from_html(html)
-    outputs = [model.Output.query.get(hash=__) for __ in outputs_ids]
-    answers = [model.Qa.query.get(hash=__) for __ in answers_ids]
+    outputs = _find_by_placeholders(model.Output, outputs_ids)
+    answers = _find_by_placeholders(model.Qa, answers_ids)
     return outputs, answers
 
 
-def entity_from_hash(hash):
-    output = Output.query.get(hash=hash)
-    precondition = Precondition.query.get(hash=hash)
-    qa = Qa.query.get(hash=hash)
-    document = Document.query.get(hash=hash)
-    entity = list(filter(None, [output, precondition, qa, document]))
-    if len(entity):
-        return entity[0]
+def _find_by_placeholders(cls, placeholders):
+    """Loads the entities with a single query, keeping order and None for the missing ones"""
+    if not placeholders:
+        return []
+    found = {}
+    for __ in cls.query.find(placeholders_query(set(placeholders))):
+        for placeholder in __.placeholders:
+            found.setdefault(placeholder, __)
+    return [found.get(__) for __ in placeholders]
 
-    return None
+
+_hash_tags = {cls.HASH_TAG: cls for cls in (Output, Precondition, Qa, Document)}
+
+
+def entity_from_hash(hash):
+    """The hash tells the type of the entity, so a single collection is queried"""
+    cls = _hash_tags.get(hash[:1]) if hash else None
+    return cls.by_hash(hash) if cls else None
 
 
 def entity_from_id(_id):
@@ -94,28 +139,104 @@ def entity_from_id(_id):
         oid = ObjectId(_id)
     except InvalidId:
         return None
-    output = Output.query.get(_id=oid)
-    precondition = Precondition.query.get(_id=oid)
-    qa = Qa.query.get(_id=oid)
-    document = Document.query.get(_id=oid)
-    entity = list(filter(None, [output, precondition, qa, document]))
-    if len(entity):
-        return entity[0]
-
+    # ids do not tell the type of the entity, stop at the first collection that has it
+    for cls in (Output, Precondition, Qa, Document):
+        if _types.get(str(oid), cls) is not cls:
+            continue
+        entity = cls.query.get(_id=oid)
+        if entity:
+            _types.put(str(oid), cls)
+            return entity
     return None
 
 
+_types = LRUCache(8192)
+"""Type of the entities by id, the only thing that never changes about them"""
+
+
+def _resolve(values, field, other, classes):
+    """Maps each of ``values`` of ``field`` to the ``other`` field of its entity,
+    with one ``$in`` query per collection of ``classes``.
+
+    Entities are edited by any process, so across requests only their type
+    is cached and a collection is not queried for the ids known to be in
+    another one. Within a request what was resolved, either way, is reused
+    until an entity is saved.
+    """
+    resolved = {}
+    memo = _request_memo()
+    for cls in classes:
+        known = memo.setdefault((field, other, cls), {})
+        reverse = memo.setdefault((other, field, cls), {})
+        pending = []
+        for __ in values:
+            if __ in resolved or (field == '_id' and _types.get(__, cls) is not cls):
+                continue
+            if __ in known:
+                resolved[__] = known[__]
+            else:
+                pending.append(__)
+        if not pending:
+            continue
+        query = [ObjectId(__) for __ in pending] if field == '_id' else pending
+        for doc in mapper(cls).collection.m.collection.find({field: {'$in': query}}, {field: 1, other: 1}):
+            resolved[str(doc[field])] = known[str(doc[field])] = str(doc[other])
+            reverse[str(doc[other])] = str(doc[field])
+            _types.put(str(doc['_id']), cls)
+    return resolved
+
+
+def _request_memo():
+    try:
+        return tg.request.environ.setdefault('ksweb.resolved', {})
+    except TypeError:
+        # not in a request, nothing is remembered
+        return {}
+
+
+def forget_resolved():
+    """Entities are being saved, what the request resolved could be stale"""
+    try:
+        tg.request.environ.pop('ksweb.resolved', None)
+    except TypeError:
+        pass
+
+
+def resolve_hashes(ids, *classes):
+    """``{_id: hash}`` of the entities with the given ``ids``, looked for in ``classes`` or in all of them.
+
+    Ids of no entity are left out of the result.
+    """
+    ids = {str(__) for __ in ids if ObjectId.is_valid(__)}
+    return _resolve(ids, '_id', 'hash', classes or (Output, Precondition, Qa, Document))
+
+
+def resolve_ids(placeholders, *classes):
+    """``{placeholder: _id}`` of the entities referenced by ``placeholders``.
+
+    Placeholders can be ids, returned as they are, or hashes, looked for
+    in ``classes`` or in the collection their tag belongs to.
+    Hashes of no entity are left out of the result.
+    """
+    resolved, by_class = {}, {}
+    for __ in set(placeholders):
+        if ObjectId.is_valid(__):
+            resolved[__] = __
+            continue
+        for cls in classes or [_hash_tags.get(__[:1])]:
+            if cls:
+                by_class.setdefault(cls, set()).add(__)
+    for cls, hashes in by_class.items():
+        resolved.update(_resolve(hashes - set(resolved), 'hash', '_id', [cls]))
+    return resolved
+
+
 def hash_to_id(_hash, cls):
-    me = cls.query.get(hash=_hash)
-    return str(me._id) if me else _hash
+    return resolve_ids([_hash], cls).get(_hash, _hash)
 
 
 def id_to_hash(_id, cls):
-    try:
-        me = cls.query.get(ObjectId(_id))
-    except InvalidId:
-        return _id
-    return me.hash if me else _id
+    return resolve_hashes([_id], cls).get(str(_id), _id)
 
 
 def ksweb_error_handler(*args, **kw):  # pragma: nocover
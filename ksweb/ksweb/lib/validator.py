@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from ksweb.lib.utils import get_entities_from_str
+from ksweb.lib.graph import EntityLookup
 from tg.validation import TGValidationError
 
 try:
@@ -64,7 +64,7 @@ class QuestionaryExistValidator(EntityValidator):
 
 class OutputContentValidator(Validator):
     def _validate_python(self, value, state=None):
-        outputs, answers = get_entities_from_str(value)
+        outputs, answers = EntityLookup().entities_from_html(value)
         if None in outputs:
             raise ValidationError(l_(u'Output not found.'), self)
         if None in answers:
@@ -73,6 +73,6 @@ class OutputContentValidator(Validator):
 
 class DocumentContentValidator(Validator):
     def _validate_python(self, value, state=None):
-        outputs, __ = get_entities_from_str(value)
+        outputs, __ = EntityLookup().entities_from_html(value)
         if None in outputs:
             raise ValidationError(l_(u'Output not found.'), self)
@@ -22,5 +22,6 @@ from ksweb.model.output import Output
 from ksweb.model.document import Document
 from ksweb.model.questionary import Questionary
 from ksweb.model.workspace import Workspace
+from ksweb.model.render_cache import RenderCache
 
-__all__ = ['User', 'Group', 'Permission', 'Workspace', 'Qa', 'Precondition', 'Output', 'Document', 'Questionary']
+__all__ = ['User', 'Group', 'Permission', 'Workspace', 'Qa', 'Precondition', 'Output', 'Document', 'Questionary', 'RenderCache']
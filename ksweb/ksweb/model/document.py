@@ -11,6 +11,8 @@ from ksweb.model.mapped_entity import MappedEntity, TriggerExtension
 
 
 class Document(MappedEntity):
+    HASH_TAG = 'd'
+
     class __mongometa__:
         session = DBSession
         name = 'documents'
@@ -19,7 +21,8 @@ class Document(MappedEntity):
             ('public',),
             ('title',),
             ('_workspace',),
-            ('html', 'text')
+            ('html', 'text'),
+            ('refs',),
         ]
         extensions = [TriggerExtension]
 
@@ -62,9 +65,20 @@ class Document(MappedEntity):
     def content(self):
         return [{'content': str(__._id), 'title': __.title, 'type': 'output'} for __ in self.children]
 
-    def exportable_dict(self):
-        filter_out = ['_workspace', '_owner', 'created_at', '_id']
+    def references(self):
+        from ksweb.model import Output
+        from ksweb.lib.utils import find_entities_from_html
+        outputs, __ = find_entities_from_html(self.html)
+        return self._referenced_ids(outputs, Output)
+
+    def exportable_dict(self, graph=None):
+        from ksweb.model import Output
+        from ksweb.lib.utils import replace_placeholders, find_entities_from_html
+        filter_out = ['_workspace', '_owner', 'created_at', '_id', 'refs']
         filter_json = {k: v for k, v in self.__json__().items() if k not in filter_out}
+        outputs, __ = find_entities_from_html(self.html)
+        hash_for_id = self._hash_for_id(graph, outputs, Output)
+        filter_json['html'] = replace_placeholders(self.html, hash_for_id, str)
         for __ in ['outputs', 'advanced_preconditions', 'qa', 'simple_preconditions']:
             filter_json[__] = {}
         return filter_json
@@ -75,22 +89,24 @@ class Document(MappedEntity):
         items.discard(None)
         return items
 
-    def __group_export_items_by_type(self):
+    def __group_export_items_by_type(self, graph):
         from itertools import groupby
-        items = list(self.export_items())
+        items = list(graph.entities)
         items.sort(key=lambda __: __.entity)
         return {k: list(v) for k, v in groupby(items, lambda __: __.entity)}
 
     def export(self):
-        json_result = self.exportable_dict()
-        items = self.__group_export_items_by_type()
+        from ksweb.lib.graph import DocumentGraph
+        graph = DocumentGraph(self)
+        json_result = self.exportable_dict(graph)
+        items = self.__group_export_items_by_type(graph)
         content_types = {'qa': 'qa',
                          'output': 'outputs',
                          'precondition/simple': 'simple_preconditions',
                          'precondition/advanced': 'advanced_preconditions'}
         for entity_name, export_name in content_types.items():
             for __ in items.get(entity_name, []):
-                json_result[export_name][__.hash] = __.exportable_dict()
+                json_result[export_name][__.hash] = __.exportable_dict(graph)
 
         return json_result
 
@@ -7,7 +7,7 @@ import pymongo
 from bson import ObjectId
 from ksweb.model import DBSession
 from ming import schema as s
-from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty, mapper, MapperExtension
+from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty, mapper, MapperExtension, state
 
 from ming.odm.declarative import MappedClass
 from tg import lurl, jsonify
@@ -16,20 +16,42 @@ from tg.util.ming import dictify
 
 
 def calculate_hash(e):
+    """Digest of the content of ``e`` tagged with its type.
+
+    The id is part of the content, so entities with the same fields still
+    have different hashes, and the tag tells which collection the hash
+    belongs to.
+    """
     prop_names = [prop.name for prop in mapper(e).properties
                   if isinstance(prop, ming.odm.property.FieldProperty)]
-    for attr in ["hash", "_id", "tags"]:
+    for attr in ["hash", "tags", "refs"]:
         if attr in prop_names: prop_names.remove(attr)
     entity = {k: getattr(e, k) for k in prop_names}
     entity_string = jsonify.encode(entity).encode()
-    return 'k' + hashlib.blake2b(entity_string, digest_size=6).hexdigest()
+    return e.HASH_TAG + hashlib.blake2b(entity_string, digest_size=16).hexdigest()
+
+
+def placeholders_query(placeholders):
+    """Query of the entities referenced by ``placeholders``, that hold their id
+    or, in content written before ids were used, their hash"""
+    ids = [ObjectId(__) for __ in placeholders if ObjectId.is_valid(__)]
+    hashes = [__ for __ in placeholders if not ObjectId.is_valid(__)]
+    return {'$or': [{'_id': {'$in': ids}}, {'hash': {'$in': hashes}}]}
 
 
 class TriggerExtension(MapperExtension):
     def before_insert(self, instance, st, sess):
-        instance.hash = calculate_hash(instance)
+        self._prepare(instance)
 
     def before_update(self, instance, st, sess):
+        self._prepare(instance)
+
+    @staticmethod
+    def _prepare(instance):
+        from ksweb.lib.utils import forget_resolved
+        forget_resolved()
+        instance.stabilize_placeholders()
+        instance.refs = sorted(set(instance.references()))
         instance.hash = calculate_hash(instance)
 
 
@@ -40,6 +62,9 @@ class MappedEntity(MappedClass):
         INCOMPLETE="INCOMPLETE"
     )
 
+    HASH_TAG = None
+    """First character of the hashes of the entity, unique for each type of entity"""
+
     _id = FieldProperty(s.ObjectId)
 
     _owner = ForeignIdProperty('User')
@@ -49,11 +74,14 @@ class MappedEntity(MappedClass):
     workspace = RelationProperty('Workspace')
 
     hash = FieldProperty(s.String)
+    """Indexed unique by the tagged_hashes evolution, once legacy hashes are rewritten"""
     title = FieldProperty(s.String, required=True)
     public = FieldProperty(s.Bool, if_missing=True)
     visible = FieldProperty(s.Bool, if_missing=True)
     status = FieldProperty(s.OneOf(*STATUS.values()), required=True, if_missing=STATUS.UNREAD)
     auto_generated = FieldProperty(s.Bool, if_missing=False)
+    refs = FieldProperty([s.ObjectId])
+    """Ids of the entities this one references, kept up to date by :class:`TriggerExtension`"""
 
     @property
     def created_at(self):
@@ -71,6 +99,40 @@ class MappedEntity(MappedClass):
     def descendants(self):
         return []
 
+    def references(self):
+        """Ids of the entities referenced by the content of this one"""
+        return []
+
+    def stabilize_placeholders(self):
+        """Rewrites the placeholders of the content that reference a hash to reference the id"""
+        html = getattr(self, 'html', None)
+        if html:
+            from ksweb.lib.utils import stable_placeholders
+            self.html = stable_placeholders(html)
+
+    @staticmethod
+    def _referenced_ids(placeholders, cls):
+        """Ids of the entities of ``cls`` referenced by ``placeholders``"""
+        refs = [ObjectId(__) for __ in placeholders if ObjectId.is_valid(__)]
+        # placeholders of content not rewritten yet may still hold hashes
+        refs.extend(cls.ids_by_hash([__ for __ in placeholders if not ObjectId.is_valid(__)]).values())
+        return refs
+
+    @staticmethod
+    def _hash_for_id(graph, ids, *classes):
+        """Rewrites the ``ids`` of entities of ``classes`` to their hash, as
+        exported entities are keyed by hash, other values are left as they are"""
+        if graph:
+            return graph.hash_for_id
+        from ksweb.lib.utils import resolve_hashes
+        hashes = resolve_hashes(ids, *classes)
+        return lambda __: hashes.get(str(__), __)
+
+    @property
+    def placeholders(self):
+        """What placeholders referencing this entity may hold"""
+        return str(self._id), self.hash
+
     @property
     def entity(self):
         return ''
@@ -102,6 +164,20 @@ class MappedEntity(MappedClass):
     def by_hash(cls, _hash):
         return cls.query.get(hash=_hash)
 
+    @classmethod
+    def by_placeholder(cls, placeholder):
+        return cls.query.find(placeholders_query([placeholder])).first()
+
+    @classmethod
+    def ids_by_hash(cls, hashes):
+        """``{hash: _id}`` of the entities with the given hashes, read without
+        loading them in the session so that it is safe while the session is flushing"""
+        if not hashes:
+            return {}
+        collection = mapper(cls).collection.m.collection
+        return {__['hash']: __['_id']
+                for __ in collection.find({'hash': {'$in': list(set(hashes))}}, {'_id': 1, 'hash': 1})}
+
     @classmethod
     def mark_as_read(cls, user_oid, workspace_id):
         from ming.odm import mapper
@@ -122,16 +198,59 @@ class MappedEntity(MappedClass):
         log = logging.getLogger(__name__)
         log.info("Please implement this method in models if some action is needed for %s => %s" % (old, self.hash))
 
+    def _update_placeholders(self, old):
+        """Rewrites the content that still references this entity by ``old``, its previous hash.
+
+        Rewriting an entity changes its hash too, so the content referencing
+        that one by hash has to be rewritten as well. The whole cascade is
+        computed in memory, with one query per collection for each level of
+        it, and written with one unordered bulk write per collection.
+        """
+        from pymongo import UpdateOne
+        from ksweb.model import Output, Document
+        from ksweb.lib.utils import replace_placeholders, forget_resolved
+        rewritten = {}
+        changed = {self._id: old}
+        while changed:
+            ids = {old_hash: str(_id) for _id, old_hash in changed.items()}
+            referencing = Output.query.find({'refs': {'$in': list(changed)}}).all() + \
+                Document.query.find({'refs': {'$in': list(changed)}}).all()
+            changed = {}
+            for e in referencing:
+                html = replace_placeholders(e.html, lambda __: ids.get(__, __), lambda __: ids.get(__, __))
+                if html == e.html:
+                    continue
+                if e._id not in rewritten:
+                    # who references it by hash uses the one stored before the cascade
+                    changed[e._id] = e.hash
+                e.html = html
+                e.hash = calculate_hash(e)
+                rewritten[e._id] = e
+
+        forget_resolved()
+        for cls in (Output, Document):
+            entities = [__ for __ in rewritten.values() if isinstance(__, cls)]
+            if not entities:
+                continue
+            mapper(cls).collection.m.collection.bulk_write([
+                UpdateOne({'_id': __._id}, {'$set': {'html': __.html, 'hash': __.hash}}) for __ in entities
+            ], ordered=False)
+            for __ in entities:
+                # already stored, the unit of work must not flush them again
+                st = state(__)
+                st.status = st.clean
+        return list(rewritten.values())
+
     def dependent_filters(self):
         from ksweb.model import Precondition
-        simple = Precondition.query.find(dict(condition=self._id)).all()
+        simple = Precondition.query.find({'refs': self._id}).all()
         simple_id = [_._id for _ in simple]
-        advanced = Precondition.query.find(dict(workspace=self._workspace, condition={'$in': simple_id})).all()
+        advanced = Precondition.query.find({'refs': {'$in': simple_id}}).all()
         return simple + advanced
 
     def dependent_outputs(self):
         from ksweb.model import Output
-        outputs = Output.query.find({'html': self.hash}).all()
+        outputs = Output.query.find({'refs': self._id}).all()
         return outputs
 
     def __json__(self):
@@ -139,6 +258,6 @@ class MappedEntity(MappedClass):
         _dict['entity'] = self.entity
         return _dict
 
-    def exportable_dict(self):
-        filter_out = ['_workspace', '_owner', 'created_at', 'auto_generated', 'status', '_id']
+    def exportable_dict(self, graph=None):
+        filter_out = ['_workspace', '_owner', 'created_at', 'auto_generated', 'status', '_id', 'refs']
         return {k: v for k, v in self.__json__().items() if k not in filter_out}
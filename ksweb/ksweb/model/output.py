@@ -4,7 +4,6 @@ from itertools import filterfalse
 
 import pymongo
 import tg
-from bson import ObjectId
 from markupsafe import Markup
 from ming import schema as s
 from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty
@@ -13,6 +12,7 @@ from ksweb.model.mapped_entity import MappedEntity, TriggerExtension
 
 
 class Output(MappedEntity):
+    HASH_TAG = 'o'
 
     class __mongometa__:
         session = DBSession
@@ -20,7 +20,7 @@ class Output(MappedEntity):
         indexes = [
             ('title',),
             ('html', 'text'),
-            ('hash',),
+            ('refs',),
         ]
         extensions = [TriggerExtension]
 
@@ -90,16 +90,17 @@ class Output(MappedEntity):
         outputs, answers = get_entities_from_str(self.html)
         return outputs + answers
 
+    def references(self):
+        from ksweb.model import Qa
+        from ksweb.lib.utils import find_entities_from_html
+        outputs, qas = find_entities_from_html(self.html)
+        refs = self._referenced_ids(outputs, Output) + self._referenced_ids(qas, Qa)
+        if self._precondition:
+            refs.append(self._precondition)
+        return refs
+
     def update_dependencies(self, old):
-        from ksweb.model import Output
-        from ksweb.model import Document
-        outputs = Output.query.find({'$text': {'$search': old}}).all()
-        documents = Document.query.find({'$text': {'$search': old}}).all()
-        for e in (outputs + documents):
-            old_hash = e.hash
-            e.html = e.html.replace(old, self.hash)
-            DBSession.flush(e)
-            e.update_dependencies(old_hash)
+        self._update_placeholders(old)
 
     def export_items(self):
         items = set([self])
@@ -109,21 +110,10 @@ class Output(MappedEntity):
             items.update(__.export_items())
         return items
 
-    def render(self, evaluations_dict):
-        if str(self._id) not in evaluations_dict:
-            return ''
-        if evaluations_dict[str(self._id)]['evaluation'] is False:
-            return ''
-
-        from ksweb.lib.utils import TemplateOutput
-        nested_output_html = dict()
-
-        for elem in self.nested_outputs:
-            nested_output = Output.query.get(_id=ObjectId(elem['content']))
-            nested_output_html[elem['content']] = nested_output.render(evaluations_dict)
-
-        ret = TemplateOutput(self.html).safe_substitute(**nested_output_html)
-        return ret
+    def render(self, evaluations_dict, context=None):
+        from ksweb.lib.render import RenderContext
+        context = context or RenderContext(evaluations_dict)
+        return context.render(self)
 
     def insert_content(self, entity):
         self.content.append(dict(
@@ -132,10 +122,16 @@ class Output(MappedEntity):
             type=entity.entity
         ))
 
-    def exportable_dict(self):
+    def exportable_dict(self, graph=None):
+        from ksweb.model import Qa
+        from ksweb.lib.utils import replace_placeholders, find_entities_from_html
         editable = super().exportable_dict()
+        outputs, answers = find_entities_from_html(self.html)
+        hash_for_id = self._hash_for_id(graph, outputs + answers, Output, Qa)
+        editable['html'] = replace_placeholders(self.html, hash_for_id, hash_for_id)
         if self._precondition:
-            editable['_precondition'] = self.precondition.hash
+            precondition = graph.precondition(self._precondition) if graph else self.precondition
+            editable['_precondition'] = precondition.hash
         return editable
 
 
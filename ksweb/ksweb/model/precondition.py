@@ -32,6 +32,7 @@ class Precondition(MappedEntity):
     PRECONDITION_TYPE = [TYPES.SIMPLE, TYPES.ADVANCED]
     PRECONDITION_OPERATOR = ['and', 'or', 'not', '(', ')']
     PRECONDITION_CONVERTED_OPERATOR = ['&', '|', 'not', '(', ')']
+    HASH_TAG = 'p'
 
     class __mongometa__:
         session = DBSession
@@ -39,7 +40,7 @@ class Precondition(MappedEntity):
         indexes = [
             ('_owner',),
             ('title',),
-            ('hash',),
+            ('refs',),
         ]
         extensions = [TriggerExtension]
 
@@ -80,31 +81,39 @@ class Precondition(MappedEntity):
 
     @property
     def response_interested(self):
+        from ksweb.lib.graph import PreconditionGraph
+        return self.responses_interested(PreconditionGraph(self))
+
+    def responses_interested(self, lookup):
+        """The questions the precondition depends on keyed by id, resolved through ``lookup``"""
         res_dict = {}
 
         if self.is_simple:
-            qa = self.get_qa()
+            qa = self.get_qa(lookup)
             if not qa:
                 return dict()
             res_dict[str(qa._id)] = qa
-            if qa.parent_precondition:
-                res_dict.update(qa.parent_precondition.response_interested)
+            parent = lookup.precondition(qa._parent_precondition)
+            if parent:
+                res_dict.update(parent.responses_interested(lookup))
             return res_dict
 
         for ___ in self.condition:
             if ___ in Precondition.PRECONDITION_OPERATOR:
                 continue
             else:
-                rel_ent = Precondition.query.get(ObjectId(___))
-                res_dict.update(rel_ent.response_interested)
+                rel_ent = lookup.precondition(___)
+                res_dict.update(rel_ent.responses_interested(lookup))
 
         return res_dict
 
-    def get_qa(self):
+    def get_qa(self, lookup=None):
         if self.is_advanced:
             return None
-        from . import Qa
-        return Qa.query.get(ObjectId(self.condition[0]))
+        if lookup is None:
+            from ksweb.lib.graph import EntityLookup
+            lookup = EntityLookup()
+        return lookup.qa_by_id(self.condition[0])
 
     @property
     def simple_text_response(self):
@@ -130,6 +139,12 @@ class Precondition(MappedEntity):
     def children(self):
         return [Precondition.query.get(_id=__) for __ in self.condition if __ not in Precondition.PRECONDITION_OPERATOR]
 
+    def references(self):
+        if self.is_simple:
+            return [ObjectId(self.condition[0])]
+        return [ObjectId(__) for __ in self.condition
+                if __ not in Precondition.PRECONDITION_OPERATOR and ObjectId.is_valid(__)]
+
     def export_items(self):
         items = set([self])
         if self.is_advanced:
@@ -138,14 +153,11 @@ class Precondition(MappedEntity):
             items.update(self.get_qa().export_items())
         return items
 
-    def exportable_dict(self):
+    def exportable_dict(self, graph=None):
         editable = super().exportable_dict()
         from ksweb.model import Qa
-        from ksweb.lib.utils import id_to_hash
-        cls = Qa if self.is_simple else self.__class__
-        editable['condition'] = []
-        for i, __ in enumerate(self.condition):
-            editable['condition'].append(id_to_hash(__, cls))
+        hash_for_id = self._hash_for_id(graph, self.condition, Qa if self.is_simple else Precondition)
+        editable['condition'] = [hash_for_id(__) for __ in self.condition]
 
         return editable
 
@@ -17,6 +17,7 @@ class Qa(MappedEntity):
         MULTI = u'multi'
 
     QA_TYPE = [TYPES.TEXT, TYPES.SINGLE, TYPES.MULTI]
+    HASH_TAG = 'q'
 
     class __mongometa__:
         session = DBSession
@@ -26,7 +27,7 @@ class Qa(MappedEntity):
             ('_owner',),
             ('_workspace',),
             ('type', 'public',),
-            ('hash',),
+            ('refs',),
         ]
         extensions = [TriggerExtension]
 
@@ -69,14 +70,11 @@ class Qa(MappedEntity):
     def dependencies(self):
         return self.dependent_filters() + self.dependent_outputs()
 
+    def references(self):
+        return [self._parent_precondition] if self._parent_precondition else []
+
     def update_dependencies(self, old):
-        from ksweb.model import Output
-        outputs = Output.query.find({'$text': {'$search': old}}).all()
-        for o in outputs:
-            old_hash = o.hash
-            o.html = o.html.replace(old, self.hash)
-            DBSession.flush(o)
-            o.update_dependencies(old_hash)
+        self._update_placeholders(old)
         self.generate_output_from()
 
     def __get_common_fields(self, **kwargs):
@@ -141,7 +139,7 @@ class Qa(MappedEntity):
         _filter = self.generate_filters_from()
         common = self.__get_common_fields()
         title = u'%s \u21d2 output' % self.title
-        common.update({'_precondition': _filter._id, 'html': '@{%s}' % self.hash, 'title': title})
+        common.update({'_precondition': _filter._id, 'html': '@{%s}' % self._id, 'title': title})
         o = Output.upsert({'title': title}, common)
         o.auto_generated = True
         o.status = Output.STATUS.UNREAD
@@ -153,10 +151,11 @@ class Qa(MappedEntity):
             items.update(self.parent_precondition.export_items())
         return items
 
-    def exportable_dict(self):
+    def exportable_dict(self, graph=None):
         editable = super().exportable_dict()
-        if self.parent_precondition:
-            editable['_parent_precondition'] = self.parent_precondition.hash
+        parent = graph.precondition(self._parent_precondition) if graph else self.parent_precondition
+        if parent:
+            editable['_parent_precondition'] = parent.hash
         return editable
 
 
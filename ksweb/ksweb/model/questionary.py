@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 """Questionary model module."""
 import logging
+from collections import OrderedDict
 
 import tg
 from bson import ObjectId
-from ksweb.model import DBSession, Document, User, Precondition, Qa
+from ksweb.model import DBSession, Document, User, Qa
 from markupsafe import Markup
+from tg.support.converters import asbool
 from ming import schema as s
-from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty
+from ming.odm import FieldProperty, ForeignIdProperty, RelationProperty, state
 from ming.odm.declarative import MappedClass
 
 log = logging.getLogger(__name__)
@@ -25,11 +27,22 @@ def _shared_with(o):
     return User.query.find({'_id': o._user}).first().email_address
 
 
+def _completion(o):
+    # questionaries listed together often share their documents, so do their graphs
+    graphs = tg.request.environ.setdefault('ksweb.document_graphs', {})
+    return o.completion_in(graphs)
+
+
+def _response(answer):
+    return answer['qa_response'] if answer else None
+
+
 class Questionary(MappedClass):
     __ROW_COLUM_CONVERTERS__ = {
         'title': _compile_questionary,
         '_owner': _owner_name,
         '_user': _shared_with,
+        'completion': _completion,
     }
 
     class __mongometa__:
@@ -42,6 +55,7 @@ class Questionary(MappedClass):
         ]
 
     _id = FieldProperty(s.ObjectId)
+    version = FieldProperty(s.Int, if_missing=0)
 
     title = FieldProperty(s.String, required=False)
 
@@ -67,6 +81,8 @@ class Questionary(MappedClass):
         evaluation: Boolean evaluation of the related precondition, for determinate if show,
                     or hide the related output text
         evaluated_text: Text of the related output when is evaluated
+        dependencies: Obj(id) of the qa the evaluation depends on
+        key: Key of the compiled precondition the evaluation comes from, it is evaluated again when it changes
     """
 
     precond_values = FieldProperty(s.Anything, if_missing={})
@@ -88,6 +104,11 @@ class Questionary(MappedClass):
         In case of multiple response of the qa, the response is a list with ['Res1', 'Resp4']
     """
 
+    answers_order = FieldProperty([s.String])
+    """
+    Stack of the Obj(id) of the answered qa, in the order they were answered
+    """
+
     @property
     def creation_date(self):
         return self._id.generation_time
@@ -96,142 +117,355 @@ class Questionary(MappedClass):
     def by_id(cls, _id):
         return cls.query.get(_id=ObjectId(_id))
 
+    @staticmethod
+    def persist_evaluations():
+        """When disabled ``expressions`` and ``output_values`` are not stored,
+        they are computed again from the compiled document when needed"""
+        return asbool(tg.config.get('questionary.persist_evaluations', True))
+
     @property
     def completion(self):
+        return self.completion_in({})
+
+    def completion_in(self, graphs):
+        """Like :attr:`completion`, ``graphs`` are the document graphs by document
+        id, shared by the questionaries when evaluations are not stored"""
         if self.completed:
             return "100 %"
-        if not len(self.expressions):
+        if self.persist_evaluations():
+            outputs_count = len(self.expressions)
+        else:
+            from ksweb.lib.graph import DocumentGraph
+            graph = graphs.get(self._document)
+            if graph is None:
+                graph = graphs[self._document] = DocumentGraph(self.document)
+            outputs_count = len(graph.outputs)
+        if not outputs_count:
             return "0 %"
-        return "%d %%" % int(len(self.qa_values)*1.0/len(self.expressions)*100)
+        return "%d %%" % int(len(self.qa_values)*1.0/outputs_count*100)
+
+    def set_answer(self, qa_id, qa_response):
+        self._answer_loaded(qa_id)
+        self._check_answers_order()
+        if qa_id in self.qa_values:
+            self.answers_order.remove(qa_id)
+            self._order_changed('pull', qa_id)
+        last = self.last_answered
+        order_number = self.qa_values[last]['order_number'] + 1 if last else 0
+        self.qa_values[qa_id] = {'qa_response': qa_response, 'order_number': order_number}
+        self.answers_order.append(qa_id)
+        self._order_changed('push', qa_id)
+        self._changed('qa_values.%s' % qa_id)
+
+    def unset_answer(self, qa_id):
+        self._answer_loaded(qa_id)
+        self._check_answers_order()
+        if self.last_answered == qa_id:
+            self.answers_order.pop()
+            self._order_changed('pop', qa_id)
+        elif qa_id in self.qa_values:
+            self.answers_order.remove(qa_id)
+            self._order_changed('pull', qa_id)
+        value = self.qa_values.pop(qa_id, None)
+        self._changed('qa_values.%s' % qa_id)
+        return value
+
+    def _check_answers_order(self):
+        """Rebuilds ``answers_order`` from ``qa_values`` when they disagree, as
+        for questionaries not reached yet by the answers order evolution.
+
+        Only the lengths are compared, answering stays constant time.
+        """
+        if len(self.answers_order) == len(self.qa_values):
+            return
+        self.answers_order = sorted(self.qa_values, key=lambda __: self.qa_values[__]['order_number'])
+        self._order_changed('set', None)
+
+    @property
+    def last_answered(self):
+        return self.answers_order[-1] if self.answers_order else None
+
+    def save_changes(self, retries=3):
+        """Persists the changes to the answers and to their evaluation.
+
+        Only the changed keys of ``qa_values``, ``output_values`` and
+        ``expressions`` are written, with ``$set`` and ``$unset``, instead of
+        the whole questionary the unit of work would save.
+
+        The update applies only if ``version`` is still the loaded one, when
+        someone else saved the questionary meanwhile the answers given here are
+        merged over the stored ones and the save is retried. Returns False,
+        and nothing is saved, if the same questions were answered differently
+        meanwhile or the retries are over.
+        """
+        from ming.odm import mapper
+        st = state(self)
+        if st.status == st.new:
+            self.discard_changes()
+            return True
+
+        collection = mapper(Questionary).collection.m.collection
+        for __ in range(retries + 1):
+            update = self._changes_update()
+            if not update:
+                break
+            version = self.version
+            update['$inc'] = {'version': 1}
+            result = collection.update_one(
+                {'_id': self._id, 'version': version or {'$in': [0, None]}}, update)
+            if result.matched_count:
+                self.version = version + 1
+                break
+            if not self._merge(collection.find_one({'_id': self._id})):
+                return self._expunge()
+        else:
+            return self._expunge()
+
+        self.discard_changes()
+        return True
+
+    def _expunge(self):
+        # the unit of work must not save them either
+        DBSession.expunge(self)
+        return False
+
+    def _changes_update(self):
+        st = state(self)
+        changed = st.extra_state.get('changed', set())
+        if not self.persist_evaluations():
+            changed = {__ for __ in changed
+                       if __.partition('.')[0] not in ('output_values', 'expressions')}
+
+        whole_fields = {__ for __ in changed if '.' not in __}
+        to_set, to_unset = {}, {}
+        for path in changed:
+            field, __, key = path.partition('.')
+            if not key:
+                to_set[path] = st.document[field]
+            elif field in whole_fields:
+                continue
+            elif key in st.document[field]:
+                to_set[path] = st.document[field][key]
+            else:
+                to_unset[path] = ''
+
+        update = {}
+        order_changes = st.extra_state.get('order_changes', [])
+        if order_changes:
+            operations = {op for op, __ in order_changes}
+            if operations == {'push'}:
+                update['$push'] = {'answers_order': {'$each': [qa_id for __, qa_id in order_changes]}}
+            elif operations == {'pop'} and len(order_changes) == 1:
+                update['$pop'] = {'answers_order': 1}
+            else:
+                to_set['answers_order'] = st.document['answers_order']
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+        return update
+
+    def _order_changed(self, operation, qa_id):
+        state(self).extra_state.setdefault('order_changes', []).append((operation, qa_id))
+
+    def _answer_loaded(self, qa_id):
+        """Remembers the answer to ``qa_id`` as it was before changing it"""
+        loaded = state(self).extra_state.setdefault('loaded_answers', {})
+        if qa_id not in loaded:
+            loaded[qa_id] = _response(self.qa_values.get(qa_id))
+
+    def _merge(self, stored):
+        """Applies the answers changed here over the ``stored`` questionary,
+        False when they conflict with the ones changed there"""
+        if stored is None:
+            return False
+        st = state(self)
+        loaded = st.extra_state.get('loaded_answers', {})
+        stored_answers = stored.get('qa_values', {})
+        for qa_id, response in loaded.items():
+            if _response(stored_answers.get(qa_id)) not in (response, _response(self.qa_values.get(qa_id))):
+                return False
+
+        answers = dict(stored_answers)
+        changed_answers = {qa_id for qa_id in set(answers) | set(self.qa_values)
+                           if _response(answers.get(qa_id)) != _response(self.qa_values.get(qa_id))}
+        order_number = max([__['order_number'] for __ in answers.values()] or [-1])
+        for qa_id in loaded:
+            if qa_id in self.qa_values:
+                order_number += 1
+                answers[qa_id] = dict(self.qa_values[qa_id], order_number=order_number)
+            else:
+                answers.pop(qa_id, None)
+
+        order = [__ for __ in stored.get('answers_order', []) if __ not in loaded]
+        order.extend(__ for __ in self.answers_order if __ in loaded)
+        st.extra_state['order_changes'] = [('set', None)]
+
+        self.qa_values = answers
+        self.answers_order = order
+        self.output_values = stored.get('output_values', {})
+        self.completed = stored.get('completed', False)
+        self.version = stored.get('version') or 0
+        self.reevaluate(*changed_answers)
+        return True
+
+    def _changed(self, *paths):
+        state(self).extra_state.setdefault('changed', set()).update(paths)
 
     @property
     def evaluate_questionary(self):
+        return self.evaluate(reset=True)
+
+    def reevaluate(self, *qa_ids, graph=None):
+        """Evaluate again only the outputs depending on ``qa_ids``,
+        the questions just answered or removed"""
+        from ksweb.lib.graph import DocumentGraph
+        self.invalidate(*qa_ids)
+        return self._evaluate(graph or DocumentGraph(self.document))
+
+    def invalidate(self, *qa_ids):
+        """Drops the evaluations depending on ``qa_ids``, the next
+        evaluation computes them again"""
+        if not self.persist_evaluations():
+            self._forget_evaluations()
+        for _id, value in list(self.output_values.items()):
+            dependencies = value.get('dependencies')
+            if dependencies is None or set(qa_ids) & set(dependencies):
+                del self.output_values[_id]
+                self._changed('output_values.%s' % _id)
+
+    def evaluate(self, graph=None, reset=False, persist=True):
+        """Evaluation of the current answers.
+
+        The outputs already evaluated are reused unless ``reset``, with
+        ``persist`` False the evaluation starts from scratch, it is only kept
+        in memory and the questionary is never saved by the unit of work.
+        """
+        from ksweb.lib.graph import DocumentGraph
+        graph = graph or DocumentGraph(self.document)
+        if not persist:
+            self._forget_evaluations()
+        if reset:
+            self.output_values = {}
+            self._changed('output_values')
+            self.generate_expression(graph)
+        evaluation = self._evaluate(graph)
+        if not persist:
+            self.discard_changes()
+        return evaluation
+
+    def _forget_evaluations(self):
+        """Stored evaluations are not trusted, they could come from
+        before evaluations stopped being persisted"""
         self.output_values = {}
-        self.generate_expression()
+        self.expressions = {}
 
-        if not self.document.content:
-            return {'completed': False}
+    def discard_changes(self):
+        """Changes made so far are not going to be saved"""
+        st = state(self)
+        for __ in ('changed', 'loaded_answers', 'order_changes'):
+            st.extra_state.pop(__, None)
+        if st.status == st.dirty:
+            st.status = st.clean
 
-        for output in self.document.content:
-            output_id = output['content']
-            output_res = self.evaluate_expression(output_id)
+    @property
+    def evaluation(self):
+        """Result of the last evaluation of the answers"""
+        return state(self).extra_state.get('evaluation') or self.evaluate()
 
-            if not output_res['completed']:
-                return output_res
-            else:
-                if self.output_values[output_id].get('evaluation'):
-                    res = self.compile_output(output_id)
-                    # this need for to show other questions though output is already evaluated,
-                    # for example when output uses some response to a certain questions
-                    if res:
-                        return res
-        self.completed = True
-        return {
-            'completed': True
-        }
+    def _evaluate(self, graph):
+        evaluation = state(self).extra_state['evaluation'] = self._plan(graph)
+        return evaluation
 
-    def generate_expression(self):
-        for output in self.document.children:
-            self.expressions[str(output._id)] = self._generate(output.precondition)
-
-    def _generate(self, precondition):
-        parent_expression, expression = '', ''
-        if not precondition:
-            return "()"
-
-        if precondition.is_simple:
-            qa = precondition.get_qa()
-
-            if qa._parent_precondition:
-                parent_expression = '( %s ) and ' % self._generate(qa.parent_precondition)
-            if precondition.simple_text_response:
-                expression = "q_%s != ''" % str(precondition.condition[0])
-            elif precondition.single_choice_response:
-                expression = "q_%s == %s" % (str(precondition.condition[0]),
-                                             repr(precondition.condition[1]))
-            elif precondition.multiple_choice_response:
-                expression = "%s in q_%s" % (str(repr(precondition.condition[1])),
-                                             precondition.condition[0])
-            return parent_expression + expression
-        else:
-            advanced_expression = ""
-            for item in precondition.condition:
-                if isinstance(item, str):
-                    advanced_expression += ' %s ' % item
-                elif isinstance(item, ObjectId):
-                    p = Precondition.query.get(item)
-                    advanced_expression += '( %s )' % self._generate(p)
-
-        return advanced_expression
-
-    def compile_output(self, output_id):
-        from . import Output
-        output = Output.query.get(ObjectId(output_id))
-
-        for elem in output.content:
-            if elem['type'] == "qa_response":
-                content = self.qa_values.get(elem['content'])
-                if not content:
-                    # no answer found for this question
-                    return {'qa': elem['content']}
-            elif elem['type'] == 'output':  # nested output
-                output_nested_id = elem['content']
-                output_nested = Output.query.get(_id=ObjectId(output_nested_id))
-                if output_nested.precondition:
-                    self.expressions[str(output_nested_id)] = self._generate(output_nested.precondition)
-                    output_res = self.evaluate_expression(output_nested_id)
-                else:
-                    log.error(output_nested)
-                    log.error(elem['content'])
-                if not output_res['completed']:
-                    return output_res
-                else:
-                    if self.output_values[output_nested_id].get('evaluation'):
-                        res = self.compile_output(output_nested_id)
-                        # this need for to show other questions though output is already evaluated,
-                        # for example when output uses some response to a certain questions
-                        if res:
-                            return res
-        return None
-
-    def evaluate_expression(self, output_id):
-        expression = self.expressions[output_id]
-        answers = dict()
-
-        for _id, resp in self.qa_values.items():
-            answer = resp['qa_response']
-            if isinstance(answer, str):
-                answers['q_' + _id] = answer
-            else:
-                # lists
-                answers['q_' + _id] = "[%s]" % ' ,'.join(map(lambda x: "'%s'" % x, answer))
-
-        try:
-            evaluation = eval(expression, answers)
-        except NameError as ne:
-            message = str(getattr(ne, 'message', ne))
-            _id = message.split("'")[1][2:]
+    def _plan(self, graph):
+        outputs = [__ for __ in graph.outputs if __]
+        if not outputs:
+            return {'completed': False}
+
+        answers = {_id: resp['qa_response'] for _id, resp in self.qa_values.items()}
+        questions, seen = [], set()
+        for output in outputs:
+            questions.extend(self._plan_output(output, answers, graph, seen))
+
+        if questions:
+            questions = list(OrderedDict.fromkeys(questions))
             return {
                 'completed': False,
-                'qa': _id
+                'qa': questions[0],
+                'questions': questions,
             }
-
-        self.output_values[output_id] = {
-            'evaluation': evaluation
-        }
-
+        if not self.completed:
+            self.completed = True
+            self._changed('completed')
         return {
             'completed': True
         }
 
+    def generate_expression(self, graph=None):
+        from ksweb.lib.evaluator import compile_precondition
+        from ksweb.lib.graph import DocumentGraph
+        graph = graph or DocumentGraph(self.document)
+        for output in filter(None, graph.outputs):
+            precondition = graph.precondition(output._precondition)
+            self.expressions[str(output._id)] = compile_precondition(precondition, graph).expression
+            self._changed('expressions.%s' % output._id)
+
+    def _plan_output(self, output, answers, graph, seen):
+        """Ordered questions still reachable through ``output``,
+        the evaluation of the decided outputs is stored in ``output_values``"""
+        from ksweb.lib.evaluator import compile_precondition
+        output_id = str(output._id)
+        if output_id in seen:
+            return []
+        seen.add(output_id)
+
+        compiled = compile_precondition(graph.precondition(output._precondition), graph)
+        if self.expressions.get(output_id) != compiled.expression:
+            self.expressions[output_id] = compiled.expression
+            self._changed('expressions.%s' % output_id)
+
+        stored = self.output_values.get(output_id)
+        if stored is not None and stored.get('key') == compiled.key:
+            # still valid, neither its filter nor its questions changed since last evaluation
+            evaluation, questions = stored['evaluation'], []
+        else:
+            evaluation, questions = compiled.plan(answers)
+            if evaluation is not None:
+                self.output_values[output_id] = {
+                    'evaluation': evaluation,
+                    'dependencies': sorted(compiled.qa_ids),
+                    'key': compiled.key,
+                }
+                self._changed('output_values.%s' % output_id)
+            elif stored is not None:
+                del self.output_values[output_id]
+                self._changed('output_values.%s' % output_id)
+
+        if evaluation is False:
+            return questions
+
+        # questions used by the output text are needed as soon as the output is shown
+        nested_outputs, qas = graph.entities_from_html(output.html)
+        for nested in filter(None, nested_outputs):
+            questions = questions + self._plan_output(nested, answers, graph, seen)
+        questions.extend(str(qa._id) for qa in filter(None, qas) if str(qa._id) not in answers)
+        return questions
+
     @property
     def answers(self):
-        questions = sorted(self.qa_values.items(), key=lambda i: i[1].order_number)
-        return [dict(question=Qa.by_id(q).question, answer=a.qa_response) for q, a in questions]
+        return self.answers_from(0)
+
+    def answers_from(self, start):
+        """Recap of the answers given after the first ``start`` ones"""
+        answers_order = self.answers_order[start:]
+        qas = Qa.query.find({'_id': {'$in': [ObjectId(__) for __ in answers_order]}})
+        qas = {str(__._id): __ for __ in qas}
+        return [dict(question=qas[q].question, answer=self.qa_values[q].qa_response)
+                for q in answers_order if q in qas]
 
     @property
     def children_titles(self):
-        return [(__.title, __.hash) for __ in self.document.children]
+        return [(__.title, str(__._id)) for __ in self.document.children]
 
 
 __all__ = ['Questionary']
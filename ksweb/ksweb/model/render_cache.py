@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from ming import schema as s
+from ming.odm import FieldProperty
+from ming.odm.declarative import MappedClass
+from ksweb.model import DBSession
+
+EXPIRE_AFTER_SECONDS = 24 * 60 * 60
+
+
+class RenderCache(MappedClass):
+    """Compiled questionary html shared between processes, expired by a TTL index.
+
+    The render key is the ``_id``, so concurrent renders of the same state
+    upsert the same document.
+    """
+
+    class __mongometa__:
+        session = DBSession
+        name = 'render_cache'
+        custom_indexes = [
+            dict(fields=('created',), expireAfterSeconds=EXPIRE_AFTER_SECONDS)
+        ]
+
+    _id = FieldProperty(s.String)
+    html = FieldProperty(s.String)
+    created = FieldProperty(s.DateTime, if_missing=datetime.utcnow)
+
+    @classmethod
+    def get(cls, key):
+        found = DBSession.find(cls, {'_id': key}, refresh=True).first()
+        return found.html if found else None
+
+    @classmethod
+    def put(cls, key, html):
+        # out of the unit of work, concurrent renders of the same state just overwrite each other
+        DBSession.update(cls, {'_id': key},
+                         {'$set': {'html': html, 'created': datetime.utcnow()}}, upsert=True)
+
+
+__all__ = ['RenderCache']
@@ -0,0 +1,140 @@
+/*
+ * Evaluates a questionary in the browser from the decision graph of its
+ * document, as returned by /questionary/decision_graph, with the same rules
+ * of ksweb.lib.evaluator: filters use three-valued logic where null means
+ * that some answers are still needed.
+ *
+ * answers is an object {qa_id: qa_response} of the questions answered so far.
+ */
+var KSEvaluator = (function() {
+    var _outputRegex = /#{([^\W]+)\b}/g;
+    var _answerRegex = /@{([^\W]+)\b}/g;
+
+    var placeholders = function(html, regex) {
+        var found = [];
+        (html || '').replace(regex, function(match, _id) {
+            found.push(_id);
+            return match;
+        });
+        return found;
+    };
+
+    var plan = function(tree, answers) {
+        if (tree === true) {
+            return {value: true, questions: []};
+        }
+        var operator = tree[0];
+        if (operator === 'answered' || operator === 'eq' || operator === 'in') {
+            var qa_id = tree[1];
+            if (!(qa_id in answers)) {
+                return {value: null, questions: [qa_id]};
+            }
+            var response = answers[qa_id];
+            if (operator === 'answered') {
+                return {value: response !== '', questions: []};
+            }
+            if (operator === 'eq') {
+                return {value: response === tree[2], questions: []};
+            }
+            return {value: response.indexOf(tree[2]) !== -1, questions: []};
+        }
+        if (operator === 'not') {
+            var operand = plan(tree[1], answers);
+            return {value: operand.value === null ? null : !operand.value, questions: operand.questions};
+        }
+
+        var left = plan(tree[1], answers);
+        var right = plan(tree[2], answers);
+        var decisive = operator === 'or';
+        if (left.value === decisive || right.value === decisive) {
+            return {value: decisive, questions: []};
+        }
+        if (left.value === !decisive && right.value === !decisive) {
+            return {value: !decisive, questions: []};
+        }
+        return {value: null, questions: left.questions.concat(right.questions)};
+    };
+
+    var evaluate = function(tree, answers) {
+        return plan(tree, answers).value;
+    };
+
+    var _planOutput = function(graph, output_id, answers, seen) {
+        var output = graph.outputs[output_id];
+        if (!output || seen[output_id]) {
+            return [];
+        }
+        seen[output_id] = true;
+
+        var planned = plan(output.condition, answers);
+        if (planned.value === false) {
+            return planned.questions;
+        }
+        var questions = planned.questions;
+        placeholders(output.html, _outputRegex).forEach(function(nested) {
+            questions = questions.concat(_planOutput(graph, nested, answers, seen));
+        });
+        placeholders(output.html, _answerRegex).forEach(function(qa_id) {
+            var qa = graph.qas[qa_id];
+            if (qa && !(qa.id in answers)) {
+                questions.push(qa.id);
+            }
+        });
+        return questions;
+    };
+
+    /* Next questions of the questionary, like quest_compiled of the server */
+    var planDocument = function(graph, answers) {
+        var outputs = placeholders(graph.html, _outputRegex).filter(function(output_id) {
+            return output_id in graph.outputs;
+        });
+        if (!outputs.length) {
+            return {completed: false};
+        }
+
+        var questions = [], seen = {};
+        outputs.forEach(function(output_id) {
+            _planOutput(graph, output_id, answers, seen).forEach(function(qa_id) {
+                if (questions.indexOf(qa_id) === -1) {
+                    questions.push(qa_id);
+                }
+            });
+        });
+        if (questions.length) {
+            return {completed: false, qa: questions[0], questions: questions};
+        }
+        return {completed: true};
+    };
+
+    var _escape = function(value) {
+        return String(value).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+                            .replace(/"/g, '&#34;').replace(/'/g, '&#39;');
+    };
+
+    /* Compiled text of the questionary, placeholders of the outputs not shown are left in place */
+    var render = function(graph, answers) {
+        var rendered = {};
+        var renderOutput = function(output_id) {
+            if (!(output_id in rendered)) {
+                rendered[output_id] = graph.outputs[output_id].html.replace(_outputRegex, expand);
+            }
+            return rendered[output_id];
+        };
+        var expand = function(match, output_id) {
+            var output = graph.outputs[output_id];
+            return (output && evaluate(output.condition, answers)) ? renderOutput(output_id) : match;
+        };
+
+        return graph.html.replace(_outputRegex, expand).replace(_answerRegex, function(match, qa_id) {
+            var qa = graph.qas[qa_id];
+            return (qa && qa.id in answers) ? _escape(answers[qa.id]) : match;
+        });
+    };
+
+    return {
+        plan: plan,
+        evaluate: evaluate,
+        planDocument: planDocument,
+        render: render,
+    }
+})();
@@ -81,6 +81,8 @@ class TestController(object):
 
     def tearDown(self):
         """Tear down test fixture for each functional test method."""
+        # entities changed and not saved by a test must not be flushed by the next one
+        DBSession.clear()
         teardown_db()
 
     def _login_admin(self):
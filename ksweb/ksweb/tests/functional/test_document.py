@@ -91,6 +91,26 @@ class TestDocument(TestController):
         response = self.app.get('/document/export', params=dict(_id=str(document._id)))
         assert b"Document" in response.body, response.body
 
+    def test_outputs_report(self):
+        self._login_lawyer()
+        ws = self._get_workspace('Area 1')
+        self._create_fake_advanced_precondition_red_animal('Red or animal')
+        red = self._get_precond_by_title('Red is Favourite')
+        output = self._create_output('Red output', ws._id, red._id, 'red')
+        document = self._create_document('Report', ws._id, '#{%s}' % output._id)
+        color = str(red.condition[0])
+        for title, response in [('Red', 'Red'), ('Blu', 'Blu')]:
+            questionary = self._create_questionary(title, document._id)
+            questionary.set_answer(color, response)
+            assert questionary.save_changes()
+        self._create_questionary('Unanswered', document._id)
+
+        resp = self.app.get('/document/outputs_report', params={'_id': str(document._id)}).json
+        eq_(resp['outputs'], [str(output._id)])
+        titles = {str(self._get_questionary_by_title(__)._id): __ for __ in ('Red', 'Blu', 'Unanswered')}
+        rows = {titles[q]: row for q, row in zip(resp['questionaries'], resp['matrix'])}
+        eq_(rows, {'Red': [True], 'Blu': [False], 'Unanswered': [False]})
+
     def test_document_import(self):
         self._login_lawyer()
         workspace = self._get_workspace("Area 1")
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import os
+
+import dukpy
+from nose.tools import eq_
+
+import ksweb
+from ksweb.lib.evaluator import compile_precondition, decision_graph, bulk_evaluate, ALWAYS
+from ksweb.tests import TestController
+
+
+class TestEvaluator(TestController):
+    application_under_test = 'main'
+
+    def setUp(self):
+        TestController.setUp(self)
+        self._login_lawyer()
+        self.advanced = self._create_fake_advanced_precondition_red_animal('Advanced_precond')
+        self.color = self._get_qa_by_title('Favourite color')
+        self.animal = self._get_qa_by_title('Animal liked')
+
+    def test_no_precondition(self):
+        eq_(compile_precondition(None), ALWAYS)
+        eq_(ALWAYS.evaluate({}), True)
+        eq_(ALWAYS.expression, '()')
+
+    def test_simple(self):
+        compiled = compile_precondition(self._get_precond_by_title('Red is Favourite'))
+        eq_(compiled.evaluate({str(self.color._id): 'Red'}), True)
+        eq_(compiled.evaluate({str(self.color._id): 'Blu'}), False)
+
+    def test_advanced(self):
+        compiled = compile_precondition(self.advanced)
+        eq_(compiled.evaluate({str(self.color._id): 'Red'}), True)
+        eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Cat', 'Dog']}), True)
+        eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Cat']}), False)
+
+    def test_unanswered(self):
+        compiled = compile_precondition(self.advanced)
+        eq_(compiled.evaluate({str(self.color._id): 'Blu'}), None)
+        eq_(compiled.plan({str(self.color._id): 'Blu'}), (None, [str(self.animal._id)] * 2))
+
+    def test_plan_reachable_questions(self):
+        compiled = compile_precondition(self.advanced)
+        value, questions = compiled.plan({})
+        eq_(value, None)
+        eq_(questions, [str(self.color._id), str(self.animal._id), str(self.animal._id)])
+        eq_(compiled.plan({str(self.color._id): 'Red'}), (True, []))
+
+    def _create_combined(self, title, operator):
+        red = self._get_precond_by_title('Red is Favourite')
+        pig_dog = self._get_precond_by_title('Like pig and dog')
+        return self._create_advanced_precondition(title, self._get_workspace('Area 1')._id, [
+            {'type': 'precondition', 'content': str(red._id)},
+            {'type': 'operator', 'content': operator},
+            {'type': 'precondition', 'content': str(pig_dog._id)},
+        ])
+
+    def test_or_decided_by_right_operand(self):
+        compiled = compile_precondition(self._create_combined('Red or pig', 'or'))
+        eq_(compiled.plan({str(self.animal._id): ['Pig']}), (True, []))
+
+    def test_and_decided_by_right_operand(self):
+        compiled = compile_precondition(self._create_combined('Red and pig', 'and'))
+        eq_(compiled.plan({str(self.animal._id): ['Cat']}), (False, []))
+        eq_(compiled.plan({str(self.animal._id): ['Dog']}), (None, [str(self.color._id)]))
+
+    def test_compiled_once(self):
+        eq_(compile_precondition(self.advanced), compile_precondition(self.advanced))
+
+    def test_cache_invalidated_on_edit(self):
+        from ksweb.model import DBSession
+        compiled = compile_precondition(self.advanced)
+        self.color.title = 'Favourite colour'
+        DBSession.flush(self.color)
+        assert compile_precondition(self.advanced) is not compiled
+
+    def test_cache_keyed_by_nested_entities(self):
+        from ming.odm import mapper
+        from ksweb.model import DBSession, Precondition
+        compiled = compile_precondition(self.advanced)
+        eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Cat']}), False)
+        red = self._get_precond_by_title('Red is Favourite')
+        # edited by another process, the hash of the outer filter stays the same
+        mapper(Precondition).collection.m.collection.update_one(
+            {'_id': red._id}, {'$set': {'condition': [red.condition[0], 'Blu'], 'hash': 'pchanged'}})
+        DBSession.clear()
+
+        recompiled = compile_precondition(Precondition.query.get(_id=self.advanced._id))
+        assert recompiled is not compiled
+        eq_(recompiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Cat']}), True)
+
+    def test_tree(self):
+        red = self._get_precond_by_title('Red is Favourite')
+        eq_(compile_precondition(red).tree, ['eq', str(self.color._id), 'Red'])
+        eq_(ALWAYS.tree, True)
+        tree = compile_precondition(self.advanced).tree
+        eq_(tree[0], 'or')
+        eq_(tree[2], ['or', ['in', str(self.animal._id), 'Pig'], ['in', str(self.animal._id), 'Dog']])
+
+    def test_decision_graph(self):
+        ws = self._get_workspace('Area 1')
+        output = self._create_output('out', ws._id, self.advanced._id, 'color @{%s}' % self.color.hash)
+        document = self._create_document('Decision', ws._id, '#{%s}' % output.hash)
+        graph = decision_graph(document)
+        eq_(graph['html'], '#{%s}' % output._id)
+        eq_(graph['outputs'][str(output._id)]['html'], 'color @{%s}' % self.color._id)
+        eq_(graph['outputs'][str(output._id)]['condition'], compile_precondition(self.advanced).tree)
+        eq_(graph['qas'][str(self.color._id)]['question'], self.color.question)
+        eq_(graph['qas'][str(self.animal._id)]['type'], 'multi')
+
+    def _js(self, code, **kw):
+        path = os.path.join(os.path.dirname(ksweb.__file__), 'public', 'javascript', 'evaluator.js')
+        with open(path) as f:
+            return dukpy.evaljs([f.read(), code], **kw)
+
+    def test_js_plan_matches(self):
+        red_and_pig = self._create_combined('Red and pig', 'and')
+        color, animal = str(self.color._id), str(self.animal._id)
+        answers = [
+            {},
+            {color: 'Red'},
+            {color: 'Blu'},
+            {animal: ['Pig']},
+            {animal: ['Cat']},
+            {color: 'Blu', animal: ['Dog', 'Cat']},
+            {color: 'Red', animal: ['Cat']},
+        ]
+        for precondition in (self.advanced, red_and_pig, self._get_precond_by_title('Red is Favourite')):
+            compiled = compile_precondition(precondition)
+            for values in answers:
+                planned = self._js('var p = KSEvaluator.plan(dukpy.tree, dukpy.answers); [p.value, p.questions]',
+                                   tree=compiled.tree, answers=values)
+                eq_(tuple(planned), compiled.plan(values), (precondition.title, values))
+
+    def test_js_plan_document_matches(self):
+        ws = self._get_workspace('Area 1')
+        output = self._create_output('out', ws._id, self.advanced._id, 'color @{%s}' % self.color._id)
+        document = self._create_document('Decision', ws._id, '#{%s}' % output._id)
+        graph = decision_graph(document)
+        for values in ({}, {str(self.color._id): 'Blu'}, {str(self.color._id): 'Red'}):
+            questionary = self._create_questionary('Decision %s' % len(values), document._id)
+            for qa_id, response in values.items():
+                questionary.set_answer(qa_id, response)
+            eq_(self._js('KSEvaluator.planDocument(dukpy.graph, dukpy.answers)', graph=graph, answers=values),
+                questionary.evaluate(persist=False))
+
+    def test_results_memoized_by_dependencies(self):
+        compiled = compile_precondition(self.advanced)
+        planned = []
+        plan = compiled.root.plan
+        compiled.root.plan = lambda answers: planned.append(1) or plan(answers)
+        try:
+            eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Dog']}), True)
+            eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Dog'],
+                                   'unrelated': 'answer'}), True)
+            eq_(compiled.evaluate({str(self.color._id): 'Blu', str(self.animal._id): ['Cat']}), False)
+        finally:
+            del compiled.root.plan
+        eq_(len(planned), 2)
+
+        questions = compiled.plan({})[1]
+        questions.append('changed')
+        eq_(compiled.plan({})[1], [str(self.color._id), str(self.animal._id), str(self.animal._id)])
+
+    def test_bulk_evaluate(self):
+        ws = self._get_workspace('Area 1')
+        red = self._get_precond_by_title('Red is Favourite')
+        nested = self._create_output('Nested red', ws._id, red._id, 'red')
+        parent = self._create_output('Red or animal', ws._id, self.advanced._id, '#{%s}' % nested.hash)
+        document = self._create_document('Bulk', ws._id, '#{%s}' % parent.hash)
+        answers = [
+            {str(self.color._id): 'Red'},
+            {str(self.color._id): 'Blu', str(self.animal._id): ['Dog']},
+            {str(self.color._id): 'Blu', str(self.animal._id): ['Cat']},
+            {str(self.color._id): 'Blu'},
+        ]
+        questionaries = []
+        for i, values in enumerate(answers):
+            questionary = self._create_questionary('Bulk %s' % i, document._id)
+            for qa_id, response in values.items():
+                questionary.set_answer(qa_id, response)
+            assert questionary.save_changes()
+            questionaries.append(str(questionary._id))
+
+        evaluation = bulk_evaluate(document)
+        eq_(sorted(evaluation['questionaries']), sorted(questionaries))
+        eq_(evaluation['outputs'], sorted([str(parent._id), str(nested._id)]))
+        rows = dict(zip(evaluation['questionaries'], evaluation['matrix']))
+        shown = [{h for h, included in zip(evaluation['outputs'], rows[q]) if included}
+                 for q in questionaries]
+        eq_(shown, [{str(parent._id), str(nested._id)}, {str(parent._id)}, set(), set()])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from ming.odm import mapper
+from nose.tools import eq_, assert_raises
+from pymongo.errors import DuplicateKeyError
+from tg import config
+
+from ksweb import model
+from ksweb.config.evolutions import TaggedHashesEvolution
+from ksweb.model import Qa, DBSession
+from ksweb.tests import TestController
+
+
+class TestEvolutions(TestController):
+    application_under_test = 'main'
+
+    def setUp(self):
+        TestController.setUp(self)
+        self._login_lawyer()
+        self.ws = self._get_workspace('Area 1')
+
+    def test_tagged_hashes_from_baseline(self):
+        qas = [self._create_qa('Legacy %s' % i, self.ws._id, 'question', 'tooltip', 'link', 'text', '')
+               for i in range(2)]
+        collection = mapper(Qa).collection.m.collection
+        # baseline collections have a plain hash index and hashes shared by entities with the same content
+        collection.drop_indexes()
+        collection.create_index([('hash', 1)], name='hash_1')
+        collection.update_many({}, {'$set': {'hash': 'legacy'}})
+
+        # starting the application must not index hashes unique yet
+        model.init_model(config['tg.app_globals'].ming_datastore)
+        indexes = collection.index_information()
+        assert not [__ for __ in indexes.values() if __.get('unique') and 'hash' in dict(__['key'])]
+
+        TaggedHashesEvolution().evolve()
+        hashes = [__['hash'] for __ in collection.find({'_id': {'$in': [__._id for __ in qas]}})]
+        eq_(len(set(hashes)), 2)
+        assert all(__.startswith(Qa.HASH_TAG) for __ in hashes)
+        indexes = collection.index_information()
+        assert indexes[TaggedHashesEvolution.index_name].get('unique')
+        assert 'hash_1' not in indexes
+        with assert_raises(DuplicateKeyError):
+            collection.update_one({'_id': qas[0]._id}, {'$set': {'hash': hashes[1]}})
+        DBSession.clear()
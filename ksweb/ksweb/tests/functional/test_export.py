@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+
+import tg
+from nose.tools import eq_, assert_raises
+from tg.util.webtest import test_context
+from ksweb.lib import export
+from ksweb.tests import TestController
+
+
+class TestExport(TestController):
+    application_under_test = 'main'
+
+    def test_convert_cached(self):
+        path = export.convert('# Title', 'markdown')
+        eq_(path, export.artifact_path('# Title', 'markdown'))
+        with open(path) as f:
+            assert 'Title' in f.read()
+        inode = os.stat(path).st_ino
+        eq_(export.convert('# Title', 'markdown'), path)
+        # written once, a hit only marks it as used
+        eq_(os.stat(path).st_ino, inode)
+
+    def test_key_depends_on_format(self):
+        assert export.artifact_key('# Title', 'odt') != export.artifact_key('# Title', 'docx')
+        assert export.artifact_key('# Title', 'odt') != export.artifact_key('# Other', 'odt')
+
+    def test_concurrent_conversions(self):
+        futures = [export.submit('# Concurrent', 'odt') for __ in range(4)]
+        eq_({__.result() for __ in futures}, {export.artifact_path('# Concurrent', 'odt')})
+
+    def test_formats(self):
+        path = export.artifact_path('# Title', 'odt')
+        eq_(export.job_path(export.job_id(path)), path)
+        eq_(export.job_path('%s.sh' % ('0' * 32)), None)
+        assert_raises(ValueError, export.artifact_path, '# Title', '../odt')
+
+    def test_jobs_scoped(self):
+        path = export.artifact_path('# Title', 'odt', 'a1')
+        job = export.job_id(path)
+        eq_(export.job_scope(job), 'a1')
+        eq_(export.job_path(job), path)
+        eq_(export.job_scope(export.job_id(export.artifact_path('# Title', 'odt'))), None)
+
+    def test_status_shared(self):
+        # the state of jobs converted by other processes comes from the markers
+        path = export.artifact_path('# Elsewhere', 'odt', 'a1')
+        job = export.job_id(path)
+        eq_(export.status(job), 'unknown')
+        try:
+            with open(path + '.pending', 'w') as f:
+                f.write('running')
+            eq_(export.status(job), 'running')
+            os.utime(path + '.pending', (0, 0))
+            eq_(export.status(job), 'failed')
+            os.remove(path + '.pending')
+            open(path + '.failed', 'w').close()
+            eq_(export.status(job), 'failed')
+
+            eq_(export.submit('# Elsewhere', 'odt', 'a1').result(), path)
+            eq_(export.status(job), 'done')
+            eq_((os.path.exists(path + '.pending'), os.path.exists(path + '.failed')), (False, False))
+        finally:
+            for __ in (path, path + '.pending', path + '.failed'):
+                if os.path.exists(__):
+                    os.remove(__)
+
+    def test_prune(self):
+        with test_context(self.app):
+            tg.config['export.cache_dir'] = tempfile.mkdtemp()
+            try:
+                old = export.convert('# Old', 'markdown')
+                recent = export.convert('# Recent', 'markdown')
+                os.utime(old, (0, 0))
+                export.prune()
+                eq_((os.path.exists(old), os.path.exists(recent)), (False, True))
+
+                other = export.convert('# Other', 'markdown')
+                os.utime(recent, (time.time() - 60,) * 2)
+                tg.config['export.max_size'] = os.stat(other).st_size
+                export.prune()
+                eq_((os.path.exists(recent), os.path.exists(other)), (False, True))
+            finally:
+                shutil.rmtree(export.cache_dir())
+                tg.config.pop('export.max_size', None)
+                del tg.config['export.cache_dir']
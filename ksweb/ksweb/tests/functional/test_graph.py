@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from nose.tools import eq_
+from ksweb.lib.graph import DocumentGraph, PreconditionGraph
+from ksweb.model import DBSession, Output, Precondition, Qa
+from ksweb.tests import TestController
+
+
+class TestDocumentGraph(TestController):
+    application_under_test = 'main'
+
+    def setUp(self):
+        TestController.setUp(self)
+        self._login_lawyer()
+        self.ws = self._get_workspace('Area 1')
+        self.advanced = self._create_fake_advanced_precondition_red_animal('Advanced_precond')
+        self.color = self._get_qa_by_title('Favourite color')
+        self.nested = self._create_output('nested', self.ws._id, self.advanced._id,
+                                          'color @{%s}' % self.color.hash)
+        self.output = self._create_output('parent', self.ws._id, None, 'nested #{%s}' % self.nested.hash)
+        self.document = self._create_document('Graph', self.ws._id, '#{%s}' % self.output.hash)
+
+    def test_loads_whole_document(self):
+        graph = DocumentGraph(self.document)
+        titles = {__.title for __ in graph.entities}
+        for title in ['parent', 'nested', 'Advanced_precond', 'Red is Favourite',
+                      'Like pig and dog', 'Favourite color', 'Animal liked']:
+            assert title in titles, (title, titles)
+
+    def test_lookups(self):
+        graph = DocumentGraph(self.document)
+        eq_([__._id for __ in graph.outputs], [self.output._id])
+        eq_(graph.output(self.nested.hash)._id, self.nested._id)
+        eq_(graph.qa_by_id(self.color._id)._id, self.color._id)
+        eq_(graph.precondition(self.advanced._id)._id, self.advanced._id)
+        eq_(graph.hash_for_id(self.color._id), self.color.hash)
+        eq_(graph.hash_for_id('and'), 'and')
+        outputs, answers = graph.entities_from_html(self.output.html)
+        eq_(([__._id for __ in outputs], answers), ([self.nested._id], []))
+
+    def test_export_matches_entities(self):
+        exported = self.document.export()
+        eq_(set(exported['outputs']), {self.output.hash, self.nested.hash})
+        eq_(exported['qa'][self.color.hash]['title'], 'Favourite color')
+        assert self.advanced.hash in exported['advanced_preconditions']
+
+    def test_precondition_graph(self):
+        graph = PreconditionGraph(self.advanced)
+        titles = {__.title for __ in graph.entities}
+        for title in ['Advanced_precond', 'Red is Favourite', 'Like pig and dog',
+                      'Favourite color', 'Animal liked']:
+            assert title in titles, (title, titles)
+        assert not [__ for __ in graph.entities if isinstance(__, Output)]
+        animal = self._get_qa_by_title('Animal liked')
+        expected = {str(self.color._id), str(animal._id)}
+        eq_(set(self.advanced.response_interested), expected)
+
+        # everything is resolved in memory, nothing is queried anymore
+        for cls in (Qa, Precondition):
+            DBSession.remove(cls, {})
+        eq_(set(self.advanced.responses_interested(graph)), expected)
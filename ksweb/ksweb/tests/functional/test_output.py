@@ -252,6 +252,77 @@ class TestOutput(TestController):
         assert "human_readable_content" in resp
         assert str(out1._id) in resp
 
+    def test_references(self):
+        self._login_lawyer()
+        qa = self._create_fake_qa("Referenced")
+        nested = self._create_fake_output("Nested referenced")
+        output = self._create_output(
+            "Referencing", self.workspace._id, None, "#{%s} @{%s}" % (nested.hash, qa.hash)
+        )
+        document = self._create_document("Referencing", self.workspace._id, "#{%s}" % output.hash)
+
+        ok_(set(output.refs) == {nested._id, qa._id})
+        ok_(document.refs == [output._id])
+        ok_(nested.refs == [nested._precondition])
+        ok_([__._id for __ in nested.dependent_outputs()] == [output._id])
+        ok_(output._id in [__._id for __ in qa.dependent_outputs()])
+        related = self.app.get("/output/get_related_entities", params=dict(_id=nested._id)).json
+        ok_(related["len"] == 1)
+
+    def test_placeholders_reference_ids(self):
+        self._login_lawyer()
+        qa = self._create_fake_qa("Referenced")
+        nested = self._create_fake_output("Nested referenced")
+        output = self._create_output(
+            "Referencing", self.workspace._id, None, "#{%s} @{%s}" % (nested.hash, qa.hash)
+        )
+        ok_(output.html == "#{%s} @{%s}" % (nested._id, qa._id))
+        output_hash = output.hash
+
+        old_hash = nested.hash
+        nested.html = "Changed"
+        model.DBSession.flush(nested)
+        ok_(nested.hash != old_hash)
+        nested.update_dependencies(old_hash)
+        output = self._get_output_by_title("Referencing")
+        ok_(output.hash == output_hash)
+        ok_(output.html == "#{%s} @{%s}" % (nested._id, qa._id))
+
+        exported = output.exportable_dict()
+        ok_(exported["html"] == "#{%s} @{%s}" % (nested.hash, qa.hash))
+
+    def test_update_dependencies_of_content_referencing_hashes(self):
+        from ming.odm import mapper
+        self._login_lawyer()
+        leaf = self._create_output("Leaf", self.workspace._id, None, "leaf")
+        middle = self._create_output("Middle", self.workspace._id, None, "middle")
+        document = self._create_document("Legacy", self.workspace._id, "document")
+        # content written when placeholders held hashes
+        for cls, entity, html, refs in [
+            (model.Output, middle, "#{%s}" % leaf.hash, [leaf._id]),
+            (model.Document, document, "#{%s} #{%s}" % (middle.hash, leaf.hash), [middle._id, leaf._id]),
+        ]:
+            mapper(cls).collection.m.collection.update_one(
+                {"_id": entity._id}, {"$set": {"html": html, "refs": refs}}
+            )
+        model.DBSession.clear()
+
+        leaf = self._get_output_by_title("Leaf")
+        old_hash = leaf.hash
+        leaf.html = "changed"
+        model.DBSession.flush(leaf)
+        rewritten = leaf._update_placeholders(old_hash)
+        ok_(sorted(__.title for __ in rewritten) == ["Legacy", "Middle"])
+        model.DBSession.flush_all()
+        model.DBSession.clear()
+
+        middle = self._get_output_by_title("Middle")
+        ok_(middle.html == "#{%s}" % leaf._id)
+        document = model.Document.query.get(_id=document._id)
+        ok_(document.html == "#{%s} #{%s}" % (middle._id, leaf._id))
+        ok_(middle.hash == model.mapped_entity.calculate_hash(middle))
+        ok_(document.hash == model.mapped_entity.calculate_hash(document))
+
 
 class TestOutputPlus(TestController):
     application_under_test = "main"
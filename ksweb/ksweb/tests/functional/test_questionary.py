@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 import pytz
+import time
 from datetime import datetime
 
 from nose.tools import eq_
@@ -103,6 +104,45 @@ class TestQuestionaryController(TestController):
         assert resp["quest_compiled"]["completed"] is True, resp
         eq_(questionary.completion, "0 %")
 
+    def test_responde_evaluated_in_browser(self):
+        from ksweb.model import DBSession, Questionary
+
+        self._login_lawyer()
+        questionary = self._create_fake_questionary(
+            "FakeQuestionary", workspace_id=self.workspace._id
+        )
+        page = self.app.get(
+            "/questionary/compile", params={"_id": str(questionary._id)}
+        )
+        assert "javascript/evaluator.js" in page, page
+        graph = self.app.get(
+            "/questionary/decision_graph", params={"_id": str(questionary._id)}
+        ).json
+        qa_id = list(graph["graph"]["qas"])[0]
+
+        resp = self.app.post_json(
+            "/questionary/responde",
+            params={
+                "_id": str(questionary._id),
+                "qa_id": qa_id,
+                "qa_response": self.FAKE_RESPONSE[0],
+                "evaluate": False,
+            },
+        ).json
+        eq_(resp, {"errors": None})
+        DBSession.clear()
+        stored = Questionary.query.get(_id=questionary._id)
+        eq_(list(stored.answers_order), [qa_id])
+        eq_(stored.completed, False)
+
+        resp = self.app.post_json(
+            "/questionary/previous_question",
+            params={"_id": str(questionary._id), "evaluate": False},
+        ).json
+        eq_(resp, {"errors": None})
+        DBSession.clear()
+        eq_(dict(Questionary.query.get(_id=questionary._id).qa_values), {})
+
     def test_hack_response(self):
         self._login_lawyer()
         questionary = self._create_fake_questionary(
@@ -228,6 +268,412 @@ class TestQuestionaryController(TestController):
 
         assert resp["quest_compiled"]["completed"] is True, resp
 
+    def test_reevaluate_only_dependent_outputs(self):
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        evaluated = dict(form.output_values)
+        for value in evaluated.values():
+            assert str(qa_color._id) in value["dependencies"], value
+
+        eq_(form.reevaluate("unrelated")["completed"], True)
+        eq_(dict(form.output_values), evaluated)
+
+        form.qa_values.pop(str(qa_color._id))
+        resp = form.reevaluate(str(qa_color._id))
+        eq_(resp["completed"], False)
+        eq_(resp["qa"], str(qa_color._id))
+
+    def test_reevaluate_outputs_of_changed_filters(self):
+        from ksweb.model import DBSession
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        red = self._get_precond_by_title("Red is Favourite")
+        red.condition = [red.condition[0], "Blu"]
+        DBSession.flush(red)
+
+        resp = form.evaluate()
+        eq_(resp["completed"], False)
+        for _id, value in form.output_values.items():
+            assert "Blu" in form.expressions[_id], form.expressions
+        assert str(qa_color._id) not in resp["questions"], resp
+
+    def test_save_changes_updates_only_changed_keys(self):
+        from ksweb.model import DBSession, Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        # written by someone else meanwhile, must survive the partial update
+        DBSession.update(
+            Questionary, {"_id": form._id}, {"$set": {"qa_values.other": {"x": 1}}}
+        )
+
+        form.unset_answer(str(qa_color._id))
+        form.reevaluate(str(qa_color._id))
+        form.set_answer("new", "yes")
+        form.save_changes()
+        DBSession.flush_all()
+        DBSession.clear()
+
+        stored = Questionary.query.get(_id=form._id)
+        eq_(set(stored.qa_values), {"other", "new"})
+        eq_(stored.qa_values["new"]["qa_response"], "yes")
+        eq_(dict(stored.output_values), {})
+
+    def _answer_meanwhile(self, form, qa_id, qa_response):
+        from ming.odm import mapper
+        from ksweb.model import Questionary
+
+        mapper(Questionary).collection.m.collection.update_one(
+            {"_id": form._id},
+            {
+                "$set": {
+                    "qa_values.%s" % qa_id: {
+                        "qa_response": qa_response,
+                        "order_number": 5,
+                    }
+                },
+                "$inc": {"version": 1},
+            },
+        )
+
+    def test_answers_order_stack(self):
+        from ksweb.model import DBSession, Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        eq_(list(form.answers_order), [str(qa_color._id)])
+        eq_(form.last_answered, str(qa_color._id))
+
+        qa_animal = self._get_qa_by_title("Animal liked")
+        form.set_answer(str(qa_animal._id), ["Dog"])
+        eq_(form.qa_values[str(qa_animal._id)]["order_number"], 1)
+        eq_(
+            form._changes_update()["$push"],
+            {"answers_order": {"$each": [str(qa_animal._id)]}},
+        )
+        form.save_changes()
+        eq_([__["answer"] for __ in form.answers], ["Red", ["Dog"]])
+
+        resp = self.app.post_json(
+            "/questionary/previous_question", params={"_id": str(form._id)}
+        ).json
+        eq_(resp["previous_response"], ["Dog"])
+        DBSession.clear()
+        stored = Questionary.query.get(_id=form._id)
+        eq_(list(stored.answers_order), [str(qa_color._id)])
+
+    def test_answers_order_missing(self):
+        from ming.odm import mapper
+        from ksweb.model import DBSession, Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        # not reached yet by the answers order evolution
+        mapper(Questionary).collection.m.collection.update_one(
+            {"_id": form._id}, {"$unset": {"answers_order": ""}}
+        )
+        DBSession.clear()
+
+        resp = self.app.post_json(
+            "/questionary/responde",
+            params={
+                "_id": str(form._id),
+                "qa_id": str(qa_color._id),
+                "qa_response": "Blu",
+            },
+        ).json
+        eq_([__["answer"] for __ in resp["recap"]], ["Blu"])
+        resp = self.app.post_json(
+            "/questionary/previous_question", params={"_id": str(form._id)}
+        ).json
+        eq_(resp["previous_response"], "Blu")
+        DBSession.clear()
+        stored = Questionary.query.get(_id=form._id)
+        eq_((list(stored.answers_order), stored.qa_values), ([], {}))
+
+    def test_responde_many(self):
+        self._login_lawyer()
+        self._create_fake_advanced_precondition_red_animal("Advanced_precond")
+        qa_color = self._get_qa_by_title("Favourite color")
+        qa_animal = self._get_qa_by_title("Animal liked")
+        output = self._create_output(
+            "example1",
+            self.workspace._id,
+            None,
+            "color @{%s} animal @{%s}" % (qa_color.hash, qa_animal.hash),
+        )
+        document = self._create_document(
+            "Prefilled_document", self.workspace._id, "#{%s}" % output.hash
+        )
+        questionary = self._create_questionary("Prefilled", document._id)
+
+        invalid = [
+            {str(qa_color._id): "Purple"},
+            {str(qa_color._id): ["Red"]},
+            {str(qa_animal._id): ["Dog", "Lion"]},
+            {str(qa_animal._id): [["Dog"]]},
+            {"missing": "x"},
+        ]
+        for answers in invalid:
+            answers = dict(answers)
+            if str(qa_color._id) not in answers:
+                answers[str(qa_color._id)] = "Red"
+            resp = self.app.post_json(
+                "/questionary/responde_many",
+                params={"_id": str(questionary._id), "answers": answers},
+                status=412,
+            ).json
+            eq_(len(resp["errors"]), 1, resp)
+        stored = self._get_questionary_by_title("Prefilled")
+        eq_(stored.qa_values, {})
+
+        resp = self.app.post_json(
+            "/questionary/responde_many",
+            params={
+                "_id": str(questionary._id),
+                "answers": {str(qa_color._id): "Red", str(qa_animal._id): "Dog"},
+            },
+        ).json
+        eq_(resp["quest_compiled"]["completed"], True)
+        eq_([__["answer"] for __ in resp["recap"]], ["Red", ["Dog"]])
+        assert "color Red animal" in resp["html"], resp["html"]
+
+    def test_compile_does_not_write(self):
+        from ming.odm import mapper
+        from ksweb.model import Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        collection = mapper(Questionary).collection.m.collection
+        stored = collection.find_one({"_id": form._id})
+        collection.update_one(
+            {"_id": form._id}, {"$set": {"output_values": {}, "expressions": {}}}
+        )
+
+        for url in ["/questionary/compile.json", "/questionary/completed"]:
+            self.app.get(url, params={"_id": str(form._id)})
+        after = collection.find_one({"_id": form._id})
+        eq_(after["version"], stored["version"])
+        eq_((after["output_values"], after["expressions"]), ({}, {}))
+
+    def test_render_ignores_stored_evaluations(self):
+        from ming.odm import mapper
+        from ksweb.model import DBSession, Questionary
+
+        self._login_lawyer()
+        output = self._create_output("always", self.workspace._id, None, "ALWAYS")
+        document = self._create_document(
+            "Stale_document", self.workspace._id, "#{%s}" % output.hash
+        )
+        questionary = self._create_questionary("Stale", document._id)
+        # stale, as after editing the filter of the output
+        mapper(Questionary).collection.m.collection.update_one(
+            {"_id": questionary._id},
+            {
+                "$set": {
+                    "output_values": {
+                        str(output._id): {"evaluation": False, "dependencies": []}
+                    }
+                }
+            },
+        )
+        DBSession.clear()
+
+        response = self.app.get(
+            "/questionary/download",
+            params=dict(_id=str(questionary._id), format="markdown"),
+        )
+        assert "ALWAYS" in response.text, response.text
+        page = self.app.get(
+            "/questionary/compile.json", params={"_id": str(questionary._id)}
+        ).json
+        assert "ALWAYS" in page["html"], page["html"]
+
+    def test_responde_delta(self):
+        self._login_lawyer()
+        self._create_fake_advanced_precondition_red_animal("Advanced_precond")
+        qa_color = self._get_qa_by_title("Favourite color")
+        red = self._get_precond_by_title("Red is Favourite")
+        shown = self._create_output(
+            "shown", self.workspace._id, None, "color @{%s}" % qa_color.hash
+        )
+        red_only = self._create_output("red only", self.workspace._id, red._id, "RED")
+        static = self._create_output("static", self.workspace._id, None, "STATIC")
+        document = self._create_document(
+            "Delta_document",
+            self.workspace._id,
+            "#{%s} #{%s} #{%s} @{%s}"
+            % (shown.hash, red_only.hash, static.hash, qa_color.hash),
+        )
+        questionary = self._create_questionary("Delta", document._id)
+        page = self.app.get(
+            "/questionary/compile", params={"_id": str(questionary._id)}
+        )
+        assert "applyDelta" in page.text
+        # the fragments of the page are rendered once, through the render cache
+        from ksweb.model import RenderCache
+        from ksweb.lib.graph import DocumentGraph
+        from ksweb.lib.render import render_key
+
+        graph = DocumentGraph(document)
+        assert RenderCache.get(render_key(graph, {}) + ".fragments") is not None
+
+        resp = self.app.post_json(
+            "/questionary/responde",
+            params={
+                "_id": str(questionary._id),
+                "qa_id": str(qa_color._id),
+                "qa_response": "Blu",
+                "delta": True,
+            },
+        ).json
+        eq_(resp["outputs"], {str(shown._id): "color Blu"})
+        eq_(resp["answers"], {str(qa_color._id): "Blu"})
+        eq_(resp["recap"]["kept"], 0)
+        eq_([__["answer"] for __ in resp["recap"]["answers"]], ["Blu"])
+        assert "html" not in resp and "questionary" not in resp
+
+        resp = self.app.post_json(
+            "/questionary/previous_question",
+            params={"_id": str(questionary._id), "delta": True},
+        ).json
+        eq_(resp["previous_response"], "Blu")
+        eq_(resp["outputs"], {str(shown._id): "color @{%s}" % qa_color._id})
+        eq_(resp["answers"], {str(qa_color._id): None})
+        eq_(resp["recap"], {"kept": 0, "answers": []})
+
+    def test_save_changes_merges_concurrent_answers(self):
+        from ksweb.model import DBSession, Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        version = form.version
+        self._answer_meanwhile(form, "other", "yes")
+
+        form.set_answer(str(qa_color._id), "Blu")
+        form.reevaluate(str(qa_color._id))
+        eq_(form.save_changes(), True)
+        eq_(form.version, version + 2)
+        eq_(form.qa_values["other"]["qa_response"], "yes")
+        DBSession.clear()
+
+        stored = Questionary.query.get(_id=form._id)
+        eq_(stored.version, version + 2)
+        eq_(stored.qa_values[str(qa_color._id)]["qa_response"], "Blu")
+        eq_(stored.qa_values[str(qa_color._id)]["order_number"], 6)
+        eq_(stored.qa_values["other"]["qa_response"], "yes")
+
+    def test_save_changes_conflict(self):
+        from ksweb.model import DBSession, Questionary
+
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        qa_color = self._get_qa_by_title("Favourite color")
+        self._answer_meanwhile(form, str(qa_color._id), "Green")
+
+        form.set_answer(str(qa_color._id), "Blu")
+        form.reevaluate(str(qa_color._id))
+        eq_(form.save_changes(), False)
+        DBSession.clear()
+
+        stored = Questionary.query.get(_id=form._id)
+        eq_(stored.qa_values[str(qa_color._id)]["qa_response"], "Green")
+
+    def test_evaluations_not_persisted(self):
+        import tg
+        from ksweb.model import DBSession, Questionary
+
+        with test_context(self.app):
+            tg.config["questionary.persist_evaluations"] = False
+        try:
+            self.test_compile_advanced_questionary()
+            form = self._get_questionary_by_title("Advanced_Questionary")
+            DBSession.clear()
+            stored = Questionary.query.get(_id=form._id)
+            eq_(dict(stored.output_values), {})
+            eq_(dict(stored.expressions), {})
+            eq_(len(stored.qa_values), 1)
+            eq_(stored.completion, "100 %")
+
+            # stored before evaluations stopped being persisted, they are ignored
+            expressions = {}
+            stored.evaluate(persist=False)
+            for _id in stored.output_values:
+                expressions[_id] = stored.expressions[_id]
+            stale = {
+                _id: dict(stored.output_values[_id], evaluation=False)
+                for _id in expressions
+            }
+            DBSession.update(
+                Questionary,
+                {"_id": form._id},
+                {"$set": {"output_values": stale, "expressions": expressions}},
+            )
+            DBSession.clear()
+            stored = Questionary.query.get(_id=form._id)
+            eq_(stored.evaluate(persist=False)["completed"], True)
+            for value in stored.output_values.values():
+                eq_(value["evaluation"], True)
+
+            html = self.app.get(
+                "/questionary/compile.json", params={"_id": str(form._id)}
+            ).json["html"]
+            assert "some html" in html, html
+
+            stored.completed = False
+            graphs = {}
+            with test_context(self.app):
+                eq_(stored.completion_in(graphs), "50 %")
+            eq_(list(graphs), [stored._document])
+            DBSession.clear()
+        finally:
+            with test_context(self.app):
+                del tg.config["questionary.persist_evaluations"]
+
+    def test_compile_returns_reachable_questions(self):
+        self._login_lawyer()
+        fake_advanced_precond = self._create_fake_advanced_precondition_red_animal(
+            "Advanced_precond"
+        )
+        qa_color = self._get_qa_by_title("Favourite color")
+        qa_animal = self._get_qa_by_title("Animal liked")
+        output = self._create_output(
+            "example1",
+            self.workspace._id,
+            fake_advanced_precond._id,
+            "some html @{%s}" % qa_color.hash,
+        )
+        document = self._create_document(
+            "Advanced_document", self.workspace._id, "#{%s}" % output.hash
+        )
+        questionary = self._create_questionary("Advanced_Questionary", document._id)
+
+        resp = self.app.get(
+            "/questionary/compile.json", params={"_id": str(questionary._id)}
+        ).json
+        eq_(resp["quest_compiled"]["qa"], str(qa_color._id))
+        eq_(
+            resp["quest_compiled"]["questions"],
+            [str(qa_color._id), str(qa_animal._id)],
+        )
+
+        resp = self.app.post_json(
+            "/questionary/responde",
+            params={
+                "_id": str(questionary._id),
+                "qa_id": str(qa_color._id),
+                "qa_response": "Blu",
+            },
+        ).json
+        eq_(resp["quest_compiled"]["questions"], [str(qa_animal._id)])
+
     def test_download(self):
         self.test_compile_advanced_questionary()
         form = self._get_questionary_by_title("Advanced_Questionary")
@@ -239,6 +685,91 @@ class TestQuestionaryController(TestController):
             assert response
             assert str(form._id) in response.content_disposition
 
+        response = self.app.get("/questionary/download", params=dict(_id=str(form._id)))
+        assert response.content_disposition.endswith(".docx")
+        self.app.get(
+            "/questionary/download",
+            params=dict(_id=str(form._id), format="../../docx"),
+            status=400,
+        )
+        self.app.get(
+            "/questionary/prepare_download",
+            params=dict(_id=str(form._id), format="html"),
+            status=400,
+        )
+
+    def test_download_headers(self):
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        params = dict(_id=str(form._id), format="markdown")
+        response = self.app.get("/questionary/download", params=params)
+        eq_(response.content_length, len(response.body))
+        eq_(response.accept_ranges, "bytes")
+        assert response.etag
+
+        self.app.get(
+            "/questionary/download",
+            params=params,
+            headers={"If-None-Match": '"%s"' % response.etag},
+            status=304,
+        )
+        partial = self.app.get(
+            "/questionary/download",
+            params=params,
+            headers={"Range": "bytes=0-9"},
+            status=206,
+        )
+        eq_(partial.body, response.body[:10])
+        eq_(partial.content_range.length, len(response.body))
+
+    def test_prepare_download(self):
+        self.test_compile_advanced_questionary()
+        form = self._get_questionary_by_title("Advanced_Questionary")
+        job = self.app.get(
+            "/questionary/prepare_download", params=dict(_id=str(form._id), format="odt")
+        ).json
+        for __ in range(100):
+            if job["status"] == "done":
+                break
+            eq_(job["status"] in ("queued", "running"), True, job)
+            time.sleep(0.1)
+            job = self.app.get(
+                "/questionary/download_status",
+                params=dict(_id=str(form._id), job=job["job"]),
+            ).json
+        eq_(job["status"], "done")
+        response = self.app.get(job["url"])
+        assert response.content_disposition.endswith(".odt")
+
+        eq_(
+            self.app.get(
+                "/questionary/download_status",
+                params=dict(_id=str(form._id), job="../../etc/passwd"),
+            ).json["status"],
+            "unknown",
+        )
+        self.app.get(
+            "/questionary/download",
+            params=dict(_id=str(form._id), job="0" * 32 + ".odt"),
+            status=404,
+        )
+
+        # the job can be downloaded only through its questionary
+        self.test_questionary_create()
+        other = self._get_questionary_by_title("TestQuestionary")
+        eq_(
+            self.app.get(
+                "/questionary/download_status",
+                params=dict(_id=str(other._id), job=job["job"]),
+            ).json["status"],
+            "unknown",
+        )
+        self.app.get(
+            "/questionary/download",
+            params=dict(_id=str(other._id), job=job["job"]),
+            status=404,
+        )
+
     def test_completed(self):
         self.test_questionary_create()
         form = self._get_questionary_by_title("TestQuestionary")
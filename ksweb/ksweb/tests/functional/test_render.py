@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from nose.tools import eq_
+from ksweb.lib.graph import DocumentGraph
+from ksweb.lib import render as render_module
+from ksweb.lib.render import RenderContext, cached_render, render_key
+from ksweb.model import DBSession, RenderCache
+from ksweb.tests import TestController
+
+
+class TestRenderContext(TestController):
+    application_under_test = 'main'
+
+    def setUp(self):
+        TestController.setUp(self)
+        self._login_lawyer()
+        self.ws = self._get_workspace('Area 1')
+        self.qa = self._create_qa('Name', self.ws._id, 'Your name?', '', '', 'text', [])
+        self.nested = self._create_output('nested', self.ws._id, None, 'name @{%s}' % self.qa.hash)
+        self.output = self._create_output('parent', self.ws._id, None,
+                                          '#{%s} and #{%s}' % (self.nested.hash, self.nested.hash))
+        self.document = self._create_document('Render', self.ws._id, '#{%s}' % self.output.hash)
+        self.graph = DocumentGraph(self.document)
+        self.parent = self.graph.output(self.output.hash)
+
+    def test_render_nested_once(self):
+        context = RenderContext({str(self.output._id): {'evaluation': True},
+                                 str(self.nested._id): {'evaluation': True}}, self.graph)
+        rendered = []
+        _render = context._render
+        context._render = lambda o: rendered.append(o.title) or _render(o)
+
+        eq_(context.render(self.parent), 'name @{%s} and name @{%s}' % (self.qa._id, self.qa._id))
+        eq_(sorted(rendered), ['nested', 'parent'])
+
+    def test_render_hidden_nested(self):
+        context = RenderContext({str(self.output._id): {'evaluation': True},
+                                 str(self.nested._id): {'evaluation': False}}, self.graph)
+        eq_(context.render(self.parent), self.output.html)
+
+    def test_render_hidden(self):
+        context = RenderContext({str(self.output._id): {'evaluation': False}}, self.graph)
+        eq_(context.render(self.parent), '')
+        eq_(self.parent.render({}), '')
+
+    def test_render_cache(self):
+        rendered = []
+
+        def render():
+            rendered.append(1)
+            return 'html'
+
+        key = render_key(self.graph, {str(self.qa._id): {'qa_response': 'Mario', 'order_number': 0}})
+        eq_(cached_render(key, render), 'html')
+        eq_(cached_render(key, render), 'html')
+        # another process, without the rendered html in memory
+        render_module._rendered.clear()
+        eq_(cached_render(key, render), 'html')
+        eq_(len(rendered), 1)
+        RenderCache.put(key, 'other')
+        eq_(RenderCache.get(key), 'other')
+        eq_(DBSession.find(RenderCache, {'_id': key}).count(), 1)
+        assert key != render_key(self.graph, {})
+        assert key != render_key(DocumentGraph(self._create_document('Other', self.ws._id, self.document.html)),
+                                 {str(self.qa._id): {'qa_response': 'Mario', 'order_number': 0}})
@@ -3,7 +3,11 @@ import datetime
 import json
 
 from bson import ObjectId
-from ksweb.lib.utils import to_object_id, upsert_document, clone_obj, find_entities_from_html
+from nose.tools import eq_
+from ksweb.lib.utils import to_object_id, upsert_document, clone_obj, find_entities_from_html, \
+    entity_from_hash, resolve_hashes, resolve_ids
+from ming.odm import mapper
+from tg.util.webtest import test_context
 from ksweb.model import Qa, DBSession
 from ksweb.tests import TestController
 from ksweb import model
@@ -188,6 +192,49 @@ class TestUtils(TestController):
         assert isinstance(o, list)
         assert isinstance(q, list)
 
+    def test_entity_from_hash(self):
+        same = clone_obj(Qa, self.qa, {})
+        DBSession.flush(same)
+        assert same.hash != self.qa.hash
+        assert self.qa.hash.startswith('q') and len(self.qa.hash) == 33
+        assert self.prec.hash.startswith('p')
+        assert entity_from_hash(self.qa.hash)._id == self.qa._id
+        assert entity_from_hash(self.prec.hash)._id == self.prec._id
+        assert entity_from_hash('x' + self.qa.hash[1:]) is None
+        assert entity_from_hash('') is None
+
+    def test_resolve(self):
+        qa_id, prec_id = str(self.qa._id), str(self.prec._id)
+        eq_(resolve_hashes([qa_id, prec_id, 'text']), {qa_id: self.qa.hash, prec_id: self.prec.hash})
+        eq_(resolve_hashes([qa_id, prec_id], Qa), {qa_id: self.qa.hash})
+        eq_(resolve_ids([self.qa.hash, self.prec.hash, qa_id]),
+            {self.qa.hash: qa_id, self.prec.hash: prec_id, qa_id: qa_id})
+
+        # edited by another process, nothing but the type of the entities is cached
+        changed = 'q' + '0' * 32
+        eq_(resolve_ids([changed]), {})
+        mapper(Qa).collection.m.collection.update_one({'_id': self.qa._id}, {'$set': {'hash': changed}})
+        eq_(resolve_ids([changed]), {changed: qa_id})
+        eq_(resolve_hashes([qa_id]), {qa_id: changed})
+        eq_(resolve_ids([self.qa.hash]), {})
+
+    def test_resolve_memoized_in_request(self):
+        qa_id = str(self.qa._id)
+        collection = mapper(Qa).collection.m.collection
+        with test_context(self.app):
+            eq_(resolve_hashes([qa_id]), {qa_id: self.qa.hash})
+            collection.update_one({'_id': self.qa._id}, {'$set': {'hash': 'q' + '0' * 32}})
+            # the request keeps what it resolved
+            eq_(resolve_hashes([qa_id]), {qa_id: self.qa.hash})
+            eq_(resolve_ids([self.qa.hash], Qa), {self.qa.hash: qa_id})
+            # until it saves some entity
+            self.qa.title = 'Changed'
+            DBSession.flush(self.qa)
+            eq_(resolve_hashes([qa_id]), {qa_id: self.qa.hash})
+            assert self.qa.hash != 'q' + '0' * 32
+        with test_context(self.app):
+            eq_(resolve_hashes([qa_id]), {qa_id: self.qa.hash})
+
     # def test_import_qa(self):
     #     imported_id = import_qa(imported_document=self.imported_document, qa_id='5922a961c42d753c2d93263f',
     #                             workspace_id=ObjectId(self.ws._id),
@@ -36,6 +36,7 @@ install_requires = [
     "axf==0.0.19",
     "tgext.evolve==0.0.4",
     "dukpy",
+    "numpy",
 ]
 
 if py_version != (3, 2):